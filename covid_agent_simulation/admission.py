@@ -0,0 +1,80 @@
+from collections import deque
+
+import numpy as np
+
+
+class AdmissionQueue:
+    """
+    Agents of one model that are outside, by the entrance they went through,
+    and the ones waiting at home to go out.
+
+    An agent willing to go out joins the queue and stays at home until it is
+    admitted. Once per tick, after agents came back home, the agents that
+    waited the longest are admitted in the order they joined, as long as
+    fewer than num_agents_allowed agents are outside. Agents joining in the
+    same tick are in the random order they were stepped in, so the order is
+    reproducible from the seed of the model.
+
+    The mesa engine keeps its waiting agents in self.waiting, the vectorized
+    engines keep their queue as arrays and only report the counts here.
+    With many replicates every count has one value per replicate.
+    """
+    def __init__(self, num_agents_allowed, num_entrances, shape=()):
+        self.num_agents_allowed = num_agents_allowed
+        self.tick = 0
+        self.waiting = deque()
+        self.occupancy = np.zeros(shape + (num_entrances,), dtype=int)
+        self.queue_length = np.zeros(shape, dtype=int)
+        # agents admitted so far and the ticks they waited in total
+        self.admitted = np.zeros(shape, dtype=int)
+        self.total_wait = np.zeros(shape, dtype=int)
+
+    @property
+    def outside(self):
+        return self.occupancy.sum(axis=-1)
+
+    @property
+    def free_slots(self):
+        return np.maximum(self.num_agents_allowed - self.outside, 0)
+
+    @property
+    def mean_wait(self):
+        """Mean number of ticks admitted agents waited to go out."""
+        return self.total_wait / np.maximum(self.admitted, 1)
+
+    def join(self, agent):
+        agent.queued_since = self.tick
+        self.waiting.append(agent)
+        self.queue_length += 1
+
+    def admit(self):
+        """CoronavirusAgents allowed to go out in this tick, they go through enter() when they do."""
+        admitted = []
+        free_slots = int(self.free_slots)
+        while self.waiting and len(admitted) < free_slots:
+            agent = self.waiting.popleft()
+            self.record_admitted(self.tick - agent.queued_since)
+            agent.queued_since = None
+            admitted.append(agent)
+        self.queue_length -= len(admitted)
+        return admitted
+
+    def record_admitted(self, waits, replicates=None):
+        """waits: ticks every admitted agent waited, replicates: the replicate of each of them."""
+        if replicates is None:
+            self.admitted += np.size(waits)
+            self.total_wait += np.sum(waits)
+        else:
+            size = self.admitted.size
+            self.admitted += np.bincount(replicates, minlength=size).reshape(self.admitted.shape)
+            self.total_wait += np.bincount(replicates, weights=waits, minlength=size).astype(int).reshape(
+                self.admitted.shape)
+
+    def enter(self, entrance):
+        self.occupancy[entrance] += 1
+
+    def leave(self, entrance):
+        self.occupancy[entrance] -= 1
+
+    def next_tick(self):
+        self.tick += 1
@@ -1,9 +1,8 @@
 from enum import Enum
-import math
-import random
 
 import numpy as np
-from mesa import Agent
+
+EMPTY_CELL = -1
 
 
 class InteriorType(Enum):
@@ -18,167 +17,180 @@ class CoronavirusAgentState(Enum):
     RECOVERED = 3
 
 
-class CoronavirusAgent(Agent):
-    def __init__(self, unique_id, model, state, min_infection_steps=10,max_infection_steps=140, going_out_prob=0.1,
-                 max_being_out_steps=10, home_id=None, config=None, outside_agents_counter=None):
-        super().__init__(unique_id, model)
-        self.state = state
-        self.infected_steps = 0
-        self.outside_steps = 0
-        self.max_infection_steps = random.randint(min_infection_steps, max_infection_steps)
-        self.max_being_out_steps = random.randint(5,max_being_out_steps)
-        self.home_id = home_id
-        self.going_out_prob = going_out_prob
-        self.config = config
-        self.outside_agents_counter = outside_agents_counter
-
-        self.target_cell = None
+# indexed by CoronavirusAgentState value
+STATES = (None,) + tuple(CoronavirusAgentState)
 
-    def get_portrayal(self):
 
-        portrayal = {
+def agent_portrayals(config):
+    """Portrayal of a CoronavirusAgent in each state, shared by all agents of a model."""
+    portrayals = {}
+    for state in CoronavirusAgentState:
+        portrayals[state] = {
             "Layer": 1,
             "w": 0.5,
             "h": 0.5,
             "r": 0.5,
             "Filled": "true",
             #"text": self.unique_id,
-            "text_color": 'black'
+            "text_color": 'black',
+            "Shape": config["agent"][state.name.lower()]["shape"],
+            "Color": config["agent"][state.name.lower()]["color"]
         }
+    return portrayals
 
-        if self.state == CoronavirusAgentState.INFECTED:
-            portrayal["Shape"] = self.config["agent"]["infected"]["shape"]
-            portrayal["Color"] = self.config["agent"]["infected"]["color"]
 
-        elif self.state == CoronavirusAgentState.RECOVERED:
-            portrayal["Shape"] = self.config["agent"]["recovered"]["shape"]
-            portrayal["Color"] = self.config["agent"]["recovered"]["color"]
-        else:
-            portrayal["Shape"] = self.config["agent"]["healthy"]["shape"]
-            portrayal["Color"] = self.config["agent"]["healthy"]["color"]
+class Agent:
+    """
+    mesa.Agent with __slots__. mesa's Agent has none, so its subclasses always get an
+    instance __dict__, while the schedule and the grid only need unique_id, model, pos and step().
+    """
+    __slots__ = ('unique_id', 'model', 'pos')
 
-        return portrayal
+    def __init__(self, unique_id, model):
+        self.unique_id = unique_id
+        self.model = model
+        self.pos = None
+
+    def step(self):
+        pass
+
+    @property
+    def random(self):
+        return self.model.random
+
+
+class CoronavirusAgent(Agent):
+    # many models with many agents run in one process, so agents keep only what differs between them,
+    # everything shared lives in the model
+    __slots__ = ('_state', 'infected_steps', 'outside_steps', 'max_infection_steps', 'max_being_out_steps',
+                 'home_id', 'going_out_prob', 'entrance', 'queued_since', 'target_cell', 'target_index',
+                 'home_cell')
+
+    def __init__(self, unique_id, model, state, min_infection_steps=10,max_infection_steps=140, going_out_prob=0.1,
+                 max_being_out_steps=10, home_id=None):
+        super().__init__(unique_id, model)
+        # CoronavirusAgentState value
+        self._state = None
+        self.state = state
+        self.infected_steps = 0
+        self.outside_steps = 0
+        self.max_infection_steps = self.random.randint(min_infection_steps, max_infection_steps)
+        self.max_being_out_steps = self.random.randint(5, max_being_out_steps)
+        self.home_id = int(home_id) if home_id is not None else None
+        self.going_out_prob = float(going_out_prob)
+        # index of the entrance the agent went out through
+        self.entrance = None
+        # tick the agent joined the admission queue, see AdmissionQueue
+        self.queued_since = None
+
+        self.target_cell = None
+        self.target_index = None
+
+    @property
+    def state(self):
+        return STATES[self._state]
+
+    @state.setter
+    def state(self, state):
+        # the model keeps counts of agents in each state, so they don't need to be recounted every tick
+        if self._state is not None:
+            self.model.state_counts[self._state] -= 1
+        self.model.state_counts[state.value] += 1
+        self._state = state.value
+
+    def get_portrayal(self):
+        # CanvasGrid adds the position to the portrayal, so it gets a copy
+        return dict(self.model.agent_portrayals[self.state])
 
     def set_home_address(self, cell):
         self.home_cell = cell
 
     def move(self):
-        possible_steps = self.model.grid.get_neighborhood(
-            self.pos, moore=True, include_center=False
-        )
-
-        if self.__is_home(self.pos):
-            valid_id = self.home_id
-        else:
-            valid_id = InteriorType.COMMON_SPACE.value
-        valid_steps = [p for p in possible_steps if not self.__is_cell_taken(p) and
-                       self.model.get_cell_id(p) == valid_id]
-
-        cell_scores = []
-        for step in valid_steps:
-            cell_score = 0
-
-            neighbors = self.model.grid.get_neighbors(step, moore=True,
-                                                      include_center=False)
-            moore_max_objects = 8
-            agents = [x for x in neighbors if isinstance(x, CoronavirusAgent)]
-
-            if self.target_cell is not None:
-                distance_to_target = moore_distance(step, self.target_cell)
-                score_bias = 0
-                if distance_to_target > 0:
-                    # prefer cells that minimize distance to target cell
-                    cell_score += 1/distance_to_target + score_bias
-                else:
-                    cell_score += score_bias
-
-            # prefer cells where there are fever agents around
-            cell_score += 1-(len(agents)/moore_max_objects)
-            cell_scores.append(cell_score)
-
-        if len(valid_steps) > 0:
-            # There are usually more than one cell with the same score.
-            top_steps = np.argwhere(cell_scores == np.max(cell_scores)).flatten()
-            self.model.grid.move_agent(self,
-                                       valid_steps[self.random.choice(top_steps)])
+        # neighbouring cells of the same home or of the common space
+        steps = self.model.movement.walkable_neighbors(self.model.cell_index(self.pos))
+        self.model.profiler.count('neighbor_queries')
+        steps = steps[~self.model.is_cell_taken(steps)]
+        if len(steps) == 0:
+            return
+
+        # prefer cells where there are fever agents around
+        moore_max_objects = 8
+        cell_scores = 1 - self.model.count_neighbors_of_cells(steps) / moore_max_objects
+
+        if self.target_index is not None:
+            # prefer cells that minimize distance to target cell
+            distance_to_target = self.model.movement.target_distance[self.target_index, steps]
+            cell_scores += np.where(distance_to_target > 0, 1 / np.maximum(distance_to_target, 1), 0)
+
+        # There are usually more than one cell with the same score.
+        top_steps = np.flatnonzero(cell_scores == cell_scores.max())
+        self.model.move_agent(self, self.model.cell_pos(steps[self.random.choice(top_steps)]))
 
     def go_out(self):
-        self.target_cell = self.random.choice(self.model.available_target_cells)
-        entrance_cell = random.choice(self.model.common_area_entrances)
-
-        entrance_area = [(entrance_cell[1] + a, entrance_cell[0] + b)
-                         for a, b in zip([0, 0], [0, 1])]
-        entrance_area = [pos for pos in entrance_area if self.__location(pos) == InteriorType.COMMON_SPACE]
-        teleport_to_cell = random.choice(entrance_area)
-        self.model.grid.move_agent(self, teleport_to_cell)
-        self.outside_agents_counter.add()
+        self.target_index = self.random.randrange(len(self.model.available_target_cells))
+        self.target_cell = tuple(self.model.available_target_cells[self.target_index])
+        self.entrance = self.random.randrange(len(self.model.entrance_areas))
+        teleport_to_cell = self.random.choice(self.model.entrance_areas[self.entrance])
+        self.model.move_agent(self, teleport_to_cell)
+        self.model.admission.enter(self.entrance)
 
     def return_home(self):
-        self.model.grid.move_agent(self, self.home_cell)
+        self.model.move_agent(self, self.home_cell)
         self.outside_steps = 0
-        self.outside_agents_counter.subtract()
-
-    def infect(self):
-        neighbors = self.model.grid.get_neighbors(self.pos, True, False,
-                                                  len(self.model.infection_probabilities))
-        for n in neighbors:
-            if type(n) == CoronavirusAgent and \
-                    n.state == CoronavirusAgentState.HEALTHY and \
-                    self.random.uniform(0, 1) <\
-                    self.model.infection_probabilities[moore_distance(self.pos, n.pos) - 1] and \
-                    (self.home_id == n.home_id or not(self.__is_home(self.pos) or self.__is_home(n.pos))):
-                n.state = CoronavirusAgentState.INFECTED
+        self.model.admission.leave(self.entrance)
+        self.entrance = None
 
     def step(self):
-        if self.__location(self.pos) == InteriorType.HOME:
+        if self.is_at_home():
             # agent is at home and might go out
-            movement_choice = random.choices(
+            movement_choice = self.random.choices(
                 [0, 1],
                 [1-self.going_out_prob, self.going_out_prob],
                 k=1
             )
-            if movement_choice == [1]\
-                    and self.outside_agents_counter.count\
-                    < self.model.num_agents_allowed_outside:
-                self.go_out()
-            else:
-                self.move()
+            self.step_at_home(movement_choice == [1])
         else:
-            # agent location is outside
-            if self.outside_steps > self.max_being_out_steps:
-                self.return_home()
-            else:
+            self.step_outside()
+        self.update_infection()
+
+    def is_at_home(self):
+        return self.__location(self.pos) == InteriorType.HOME
+
+    def step_at_home(self, wants_out, move=True):
+        """An agent that wants out waits at home until the model admits it, see AdmissionQueue."""
+        if wants_out and self.queued_since is None:
+            self.model.admission.join(self)
+        if move:
+            with self.model.profiler.phase('move'):
                 self.move()
-                self.outside_steps += 1
 
+    def step_outside(self):
+        """Returns whether the agent came back home."""
+        profiler = self.model.profiler
+        if self.outside_steps > self.max_being_out_steps:
+            with profiler.phase('return_home'):
+                self.return_home()
+            return True
+        with profiler.phase('move'):
+            self.move()
+        self.outside_steps += 1
+        return False
+
+    def update_infection(self):
         if self.state == CoronavirusAgentState.INFECTED:
             if self.infected_steps >= self.max_infection_steps:
                 self.state = CoronavirusAgentState.RECOVERED
             else:
+                # infecting others is done for all agents at once in CoronavirusModel.spread_infection
                 self.infected_steps += 1
-                self.infect()
-
-    def __is_cell_taken(self, pos):
-        agents_in_cell = self.model.grid.get_cell_list_contents(pos)
-        for a in agents_in_cell:
-            if type(a) == CoronavirusAgent:
-                return True
-        return False
-
-    def __is_home(self, pos):
-        agents_in_cell = self.model.grid.get_cell_list_contents(pos)
-        for a in agents_in_cell:
-            if type(a) == InteriorAgent and a.home_id == self.home_id:
-                return True
-        return False
 
     def __location(self, pos):
-        this_cell = self.model.grid.get_cell_list_contents([pos])
-        interior_agent = [el for el in this_cell if type(el) == InteriorAgent]
-        return interior_agent[0].interior_type
+        return self.model.get_cell_type(pos)
 
 
 class InteriorAgent(Agent):
+    __slots__ = ('color', 'interior_type', 'home_id', 'shape')
+
     def __init__(self, unique_id, model, color="#FFFFFF", shape=None, interior_type=None, home_id=None):
         super().__init__(unique_id, model)
         self.color = color
@@ -203,6 +215,8 @@ class InteriorAgent(Agent):
 
 
 class WallAgent(Agent):
+    __slots__ = ('color', 'type')
+
     def __init__(self, unique_id, model, color="black", type='horizontal'):
         super().__init__(unique_id, model)
         self.color = color
@@ -224,7 +238,3 @@ class WallAgent(Agent):
             portrayal["h"] = 0.05
 
         return portrayal
-
-
-def moore_distance(p1, p2):
-    return math.floor(math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2))
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Runs CoronavirusModel headless for every combination of the sweep parameters.
+
+    python -m covid_agent_simulation.batch --scenario store park --num_agents 50 100 --replicates 10
+
+Every finished run is appended to <output_dir>/results.jsonl and its
+Infected/Healthy/Recovered curves are streamed to <output_dir>/series/<run_id>/.
+"""
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+
+from .cache import json_digest
+from .model import CoronavirusModel
+from .utils import get_config
+
+SWEEP_PARAMETERS = ['scenario', 'num_agents', 'going_out_prob_mean', 'seed', 'replicate']
+
+
+def load_sweep(path):
+    with open(path, 'r') as f:
+        sweep = yaml.safe_load(f)
+    # a single value is a sweep over one value
+    return {key: value if isinstance(value, list) else [value] for key, value in sweep.items()}
+
+
+def make_runs(sweep, config, steps, engine):
+    """
+    Every combination of the sweep. The run_id is a digest of everything that determines
+    the run, so sweeps appending to the same output_dir never overwrite each other's curves.
+    """
+    values = [sweep[key] for key in SWEEP_PARAMETERS]
+    runs = []
+    for combination in itertools.product(*values):
+        run = dict(zip(SWEEP_PARAMETERS, combination))
+        run['run_id'] = json_digest({'run': run, 'config': config, 'steps': steps, 'engine': engine})[:16]
+        runs.append(run)
+    return runs
+
+
+def run_replicate(config, run, steps, engine='mesa', output_dir=None, with_series=False):
+    """with_series: also return the curves, as lists by name under 'series'."""
+    model = CoronavirusModel(num_agents=run['num_agents'], config=config, scenario=run['scenario'],
+                             going_out_prob_mean=run['going_out_prob_mean'],
+                             with_interiors=False, engine=engine,
+                             seed=run['seed'], replicate=run['replicate'],
+                             output_dir=output_dir)
+    with model:
+        model.run_model(steps)
+    series = model.datacollector.get_model_vars_dataframe()
+
+    summary = dict(run,
+                   steps=steps,
+                   engine=engine,
+                   created_agents=model.num_agents,
+                   stop_reason=model.stop_reason,
+                   steps_run=len(series) - 1,
+                   peak_infected=float(series['Infected'].max()),
+                   time_to_peak=int(series['Infected'].idxmax()),
+                   final_infected=float(series['Infected'].iloc[-1]),
+                   final_healthy=float(series['Healthy'].iloc[-1]),
+                   final_recovered=float(series['Recovered'].iloc[-1]),
+                   peak_waiting=int(series['Waiting'].max()),
+                   mean_wait=float(series['Mean wait'].iloc[-1]))
+    if with_series:
+        summary['series'] = {name: series[name].tolist() for name in series.columns}
+    return summary
+
+
+def run_sweep(config, runs, steps, output_dir, engine='mesa', workers=None):
+    series_dir = os.path.join(output_dir, 'series')
+    os.makedirs(series_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            open(os.path.join(output_dir, 'results.jsonl'), 'a') as results:
+        futures = {executor.submit(run_replicate, config, run, steps, engine,
+                                   os.path.join(series_dir, run['run_id'])): run
+                   for run in runs}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                summary = future.result()
+            except Exception as err:
+                # a failed run is recorded, the rest of the sweep goes on
+                summary = dict(futures[future], steps=steps, engine=engine, error=repr(err))
+                print(f'[{i + 1}/{len(runs)}] run {summary["run_id"]} failed: {err!r}')
+            else:
+                print(f'[{i + 1}/{len(runs)}] run {summary["run_id"]}: '
+                      f'peak infected {summary["peak_infected"]:.1f}% at step {summary["time_to_peak"]}')
+            results.write(json.dumps(summary) + '\n')
+            results.flush()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=None, help="yml config, configs/designed_shapes.yml if not given")
+    parser.add_argument("--sweep", default=None,
+                        help="yml file with a list of values for any of: " + ", ".join(SWEEP_PARAMETERS))
+    parser.add_argument("--scenario", nargs='+', default=None)
+    parser.add_argument("--num_agents", nargs='+', type=int, default=None)
+    parser.add_argument("--going_out_prob_mean", nargs='+', type=float, default=None)
+    parser.add_argument("--seeds", nargs='+', type=int, default=None)
+    parser.add_argument("--num_seeds", type=int, default=None,
+                        help="run that many seeds counting up from the random_seed of the config, instead of --seeds")
+    parser.add_argument("--replicates", type=int, default=None,
+                        help="number of independent random streams spawned from every seed")
+    parser.add_argument("--steps", default=200, type=int)
+    parser.add_argument("--engine", default="mesa", choices=['mesa', 'vectorized', 'tiled'])
+    parser.add_argument("--workers", default=None, type=int)
+    parser.add_argument("--output_dir", default="batch_results")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    config = get_config(args.config)
+
+    sweep = {'scenario': ['store'], 'num_agents': [10], 'going_out_prob_mean': [0.5],
+             'seed': [config['common']['random_seed']], 'replicate': [None]}
+    if args.sweep is not None:
+        sweep.update(load_sweep(args.sweep))
+    for key in ['scenario', 'num_agents', 'going_out_prob_mean']:
+        if getattr(args, key) is not None:
+            sweep[key] = getattr(args, key)
+    if args.seeds is not None:
+        sweep['seed'] = args.seeds
+    if args.num_seeds is not None:
+        sweep['seed'] = list(range(config['common']['random_seed'], config['common']['random_seed'] + args.num_seeds))
+    if args.replicates is not None:
+        sweep['replicate'] = list(range(args.replicates))
+
+    runs = make_runs(sweep, config, args.steps, args.engine)
+    print(f'Running {len(runs)} simulations of {args.steps} steps')
+    run_sweep(config, runs, args.steps, args.output_dir, args.engine, args.workers)
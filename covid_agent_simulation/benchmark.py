@@ -0,0 +1,193 @@
+"""
+Benchmarks of model construction, stepping, agent movement, infection, data collection
+and memory used by a model.
+
+    python -m covid_agent_simulation.benchmark --num_agents 10 100 1000 --scales 1 4 --output benchmark.jsonl
+
+Maps are scaled by tiling the scenario map scale x scale times, so the largest
+agent counts need large scales (a tile of designed_shapes.yml has 114 home cells).
+Every result is appended to the output file as a json line, so results of
+different commits can be compared.
+"""
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from .agents import CoronavirusAgentState, InteriorType
+from .model import CoronavirusModel
+from .utils import get_config
+
+BENCHMARKS = ['setup', 'step', 'move', 'infection', 'collect', 'memory']
+
+
+def scaled_config(config, scenario, scale, tmp_dir):
+    """Config with the map of the scenario tiled scale x scale times, every tile with its own homes."""
+    if scale == 1:
+        return config
+    environment = config['environment'][scenario]
+    grid_map = np.load(environment['map_path'])
+    rows, cols = grid_map.shape
+    num_homes = int(grid_map.max()) - InteriorType.HOME.value + 1
+
+    tiles, entrances = [], []
+    for i in range(scale):
+        row = []
+        for j in range(scale):
+            tile = grid_map.copy()
+            homes = tile >= InteriorType.HOME.value
+            tile[homes] += (i * scale + j) * num_homes
+            row.append(tile)
+            entrances += [[r + i * rows, c + j * cols] for r, c in environment['entrance_cells']]
+        tiles.append(row)
+
+    path = os.path.join(tmp_dir, f'{scenario}_x{scale}.npy')
+    np.save(path, np.block(tiles))
+    config = copy.deepcopy(config)
+    config['environment'][scenario].update(map_path=path, entrance_cells=entrances,
+                                           num_agents_allowed=environment['num_agents_allowed'] * scale ** 2)
+    return config
+
+
+def measure(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'mean': float(np.mean(times)), 'min': float(np.min(times)),
+            'std': float(np.std(times)), 'repeats': repeats}
+
+
+def make_model(config, scenario, num_agents, engine, seed=0):
+    return CoronavirusModel(num_agents=num_agents, config=config, scenario=scenario, going_out_prob_mean=0.5,
+                            with_interiors=False, engine=engine, seed=seed)
+
+
+def bench_setup(config, scenario, num_agents, engine, repeats):
+    return measure(lambda: make_model(config, scenario, num_agents, engine), repeats)
+
+
+def bench_step(config, scenario, num_agents, engine, repeats):
+    model = make_model(config, scenario, num_agents, engine)
+    # let some agents go out first
+    model.run_model(10)
+    return measure(model.step, repeats)
+
+
+def bench_move(config, scenario, num_agents, engine, repeats):
+    """One move of every agent, engine.move for the vectorized engine."""
+    model = make_model(config, scenario, num_agents, engine)
+    model.run_model(10)
+    if engine == 'vectorized':
+        agents = np.arange(model.num_agents)
+        return measure(lambda: model.engine.move(agents), repeats)
+
+    def move_all():
+        for agent in model.schedule.agents:
+            agent.move()
+    return measure(move_all, repeats)
+
+
+def bench_infection(config, scenario, num_agents, engine, repeats):
+    """
+    The infection pass only, engine.infect for the vectorized engine, recovery
+    is left out of both since the mesa engine does it in the steps of its agents.
+    """
+    model = make_model(config, scenario, num_agents, engine)
+    model.run_model(10)
+    if engine == 'vectorized':
+        engine = model.engine
+        return measure(lambda: engine.infect(np.flatnonzero(engine.state == CoronavirusAgentState.INFECTED.value)),
+                       repeats)
+    return measure(model.spread_infection, repeats)
+
+
+def bench_collect(config, scenario, num_agents, engine, repeats):
+    model = make_model(config, scenario, num_agents, engine)
+    return measure(lambda: model.datacollector.collect(model), repeats)
+
+
+def traced_size(function):
+    """Memory allocated by function and still held by what it returns, in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()
+        # models have reference cycles, garbage made while building them is freed only by the collector
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_memory(config, scenario, num_agents, engine, repeats):
+    """Memory of a model, and per agent, i.e. compared to a model with a single agent."""
+    # the first model fills the caches of the scenario
+    make_model(config, scenario, 1, engine)
+    size = traced_size(lambda: make_model(config, scenario, num_agents, engine))
+    base = traced_size(lambda: make_model(config, scenario, 1, engine))
+    return {'model_bytes': size, 'bytes_per_agent': (size - base) / max(num_agents - 1, 1)}
+
+
+def environment_info():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def run_benchmarks(config, benchmarks, scenarios, scales, agent_counts, engines, repeats, output):
+    info = environment_info()
+    with tempfile.TemporaryDirectory() as tmp_dir, open(output, 'a') as results:
+        for scenario in scenarios:
+            for scale in scales:
+                scenario_config = scaled_config(config, scenario, scale, tmp_dir)
+                for num_agents in agent_counts:
+                    for engine in engines:
+                        for name in benchmarks:
+                            timing = globals()[f'bench_{name}'](scenario_config, scenario, num_agents,
+                                                                 engine, repeats)
+                            result = dict(info, benchmark=name, scenario=scenario, scale=scale,
+                                          num_agents=num_agents, engine=engine, **timing)
+                            results.write(json.dumps(result) + '\n')
+                            results.flush()
+                            if 'bytes_per_agent' in timing:
+                                measured = f'{timing["model_bytes"] / 1024:9.1f} KiB, ' \
+                                           f'{timing["bytes_per_agent"]:.0f} B per agent'
+                            else:
+                                measured = f'{timing["mean"] * 1000:9.3f} ms ± {timing["std"] * 1000:.3f}'
+                            print(f'{name:>10} {scenario:>7} x{scale:<3} {num_agents:>6} agents {engine:>10}: '
+                                  f'{measured}')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=None, help="yml config, configs/designed_shapes.yml if not given")
+    parser.add_argument("--benchmarks", nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument("--scenario", nargs='+', default=['store', 'park', 'forest'])
+    parser.add_argument("--scales", nargs='+', type=int, default=[1])
+    parser.add_argument("--num_agents", nargs='+', type=int, default=[10, 100])
+    parser.add_argument("--engine", nargs='+', default=['mesa', 'vectorized'], choices=['mesa', 'vectorized'])
+    parser.add_argument("--repeats", default=20, type=int)
+    parser.add_argument("--output", default="benchmark.jsonl")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    run_benchmarks(get_config(args.config), args.benchmarks, args.scenario, args.scales,
+                   args.num_agents, args.engine, args.repeats, args.output)
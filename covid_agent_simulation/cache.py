@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'covid_agent_simulation')
+
+
+def get_cache_dir(config):
+    path = config['common'].get('cache_dir') or DEFAULT_CACHE_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def array_digest(*arrays):
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def save_npz(path, **arrays):
+    # write to a temporary file first, so that workers sharing the cache never read half a file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def json_digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Results of runs as json files, one per key. Keys are digests of everything
+    that determines a result, e.g. the config, the seed and the number of steps.
+
+    With max_bytes or max_entries the least recently used results are deleted
+    once the cache grows past them. get() touches the file of a hit, so the
+    order survives restarts, but the index of the files is kept by this
+    process: only one process should put into a limited cache.
+    """
+    def __init__(self, path, max_bytes=None, max_entries=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+        # key -> size of its file, least recently used first
+        self.index = None
+        self.total_bytes = 0
+        if self.limited:
+            entries = sorted((entry.stat().st_mtime, entry.name[:-len('.json')], entry.stat().st_size)
+                             for entry in os.scandir(path) if entry.name.endswith('.json'))
+            self.index = OrderedDict((key, size) for _, key, size in entries)
+            self.total_bytes = sum(self.index.values())
+            self.evict()
+
+    @property
+    def limited(self):
+        return self.max_bytes is not None or self.max_entries is not None
+
+    def __len__(self):
+        if self.index is not None:
+            return len(self.index)
+        return sum(1 for name in os.listdir(self.path) if name.endswith('.json'))
+
+    def file(self, key):
+        return os.path.join(self.path, f'{key}.json')
+
+    def get(self, key):
+        try:
+            with open(self.file(key), 'r') as f:
+                result = json.load(f)
+        except FileNotFoundError:
+            if self.index is not None and key in self.index:
+                self.total_bytes -= self.index.pop(key)
+            return None
+        if self.index is not None:
+            self.index.move_to_end(key)
+            os.utime(self.file(key))
+        return result
+
+    def put(self, key, result):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.json.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, self.file(key))
+        if self.index is not None:
+            self.total_bytes -= self.index.pop(key, 0)
+            self.index[key] = os.path.getsize(self.file(key))
+            self.total_bytes += self.index[key]
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used results until the cache fits its limits, the newest one always stays."""
+        while len(self.index) > 1 and ((self.max_bytes is not None and self.total_bytes > self.max_bytes) or
+                                       (self.max_entries is not None and len(self.index) > self.max_entries)):
+            key, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.file(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,204 @@
+"""
+Saving the full state of a CoronavirusModel and resuming it later.
+
+A checkpoint is a single .npz file with the agents stored as arrays (one
+array per attribute, in schedule order), the curves collected so far and a
+json header with the model parameters, counters and the state of the
+random generators, so a resumed run continues exactly like the original.
+With a transmission log its events are stored too.
+"""
+import io
+import json
+
+import numpy as np
+
+from .agents import CoronavirusAgent, CoronavirusAgentState, EMPTY_CELL
+from .model import CoronavirusModel
+from .scheduling import EventActivation
+from .transmission import FIELDS as TRANSMISSION_FIELDS
+
+AGENT_FIELDS = ['unique_id', 'pos', 'home_cell', 'home_id', 'state', 'infected_steps', 'outside_steps',
+                'max_infection_steps', 'max_being_out_steps', 'going_out_prob', 'target_index', 'entrance',
+                'queued_since']
+
+
+def agent_arrays(model):
+    if model.engine is not None:
+        engine = model.engine
+        return {'unique_id': engine.ids, 'pos': engine.pos, 'home_cell': engine.home_cell,
+                'home_id': engine.home_id, 'state': engine.state, 'infected_steps': engine.infected_steps,
+                'outside_steps': engine.outside_steps, 'max_infection_steps': engine.max_infection_steps,
+                'max_being_out_steps': engine.max_being_out_steps, 'going_out_prob': engine.going_out_prob,
+                'target_index': engine.target_index, 'entrance': engine.entrance,
+                'queued_since': engine.queued_since}
+
+    agents = model.schedule.agents
+    return {'unique_id': np.array([a.unique_id for a in agents], dtype=int),
+            'pos': np.array([model.cell_index(a.pos) for a in agents], dtype=int),
+            'home_cell': np.array([model.cell_index(a.home_cell) for a in agents], dtype=int),
+            'home_id': np.array([a.home_id for a in agents], dtype=int),
+            'state': np.array([a.state.value for a in agents], dtype=np.int8),
+            'infected_steps': np.array([a.infected_steps for a in agents], dtype=int),
+            'outside_steps': np.array([a.outside_steps for a in agents], dtype=int),
+            'max_infection_steps': np.array([a.max_infection_steps for a in agents], dtype=int),
+            'max_being_out_steps': np.array([a.max_being_out_steps for a in agents], dtype=int),
+            'going_out_prob': np.array([a.going_out_prob for a in agents], dtype=float),
+            'target_index': np.array([EMPTY_CELL if a.target_index is None else a.target_index
+                                      for a in agents], dtype=int),
+            'entrance': np.array([EMPTY_CELL if a.entrance is None else a.entrance for a in agents], dtype=int),
+            'queued_since': np.array([EMPTY_CELL if a.queued_since is None else a.queued_since
+                                      for a in agents], dtype=int)}
+
+
+def save_checkpoint(model, file):
+    """file: path or file object"""
+    if model.replicates > 1:
+        raise ValueError('Checkpoints of models with many replicates are not supported')
+    if isinstance(model.schedule, EventActivation):
+        raise ValueError('Checkpoints of the event scheduler are not supported')
+    if model.engine_name == 'tiled':
+        raise ValueError('Checkpoints of the tiled engine are not supported')
+    version, random_state, gauss = model.random.getstate()
+    header = {
+        'scenario': model.scenario,
+        'num_agents': model.num_agents,
+        'engine': model.engine_name,
+        'with_interiors': model.with_interiors,
+        'seed': model.seed,
+        'spawn_key': list(model.spawn_key),
+        'replicate': model.replicate,
+        'going_out_prob_mean': model.going_out_prob_mean,
+        'num_agents_allowed_outside': model.num_agents_allowed_outside,
+        'admission_tick': model.admission.tick,
+        'admitted': int(model.admission.admitted),
+        'total_wait': int(model.admission.total_wait),
+        # order of the waiting agents of the mesa engine, the vectorized one orders them by queued_since
+        'queue': [a.unique_id for a in model.admission.waiting],
+        'global_max_index': model.global_max_index,
+        'schedule_steps': model.schedule.steps,
+        'schedule_time': model.schedule.time,
+        'steps_collected': model.datacollector.steps_collected,
+        'running': model.running,
+        'stop_reason': model.stop_reason,
+        'infected_history': [history.tolist() for history in model.infected_history],
+        'rng_state': model.rng.bit_generator.state,
+        'random_version': version,
+        'random_gauss': gauss,
+        'transmission_rng_state': model.transmission_rng.bit_generator.state,
+        'config': model.config,
+    }
+    model_vars = model.datacollector.get_model_vars_dataframe()
+    arrays = {f'agent_{name}': array for name, array in agent_arrays(model).items()}
+    arrays.update({f'model_var_{name}': model_vars[name].values for name in model_vars.columns})
+    if model.transmissions is not None:
+        arrays.update({f'transmission_{name}': values for name, values in model.transmissions.events.items()})
+    np.savez_compressed(file, header=np.array(json.dumps(header)),
+                        random_state=np.array(random_state, dtype=np.uint64),
+                        available_target_cells=model.available_target_cells,
+                        **arrays)
+
+
+def load_checkpoint(file, config=None, output_dir=None):
+    """
+    file: path or file object written by save_checkpoint.
+    config: config to build the model with, the one saved in the checkpoint by default.
+    """
+    with np.load(file) as checkpoint:
+        header = json.loads(str(checkpoint['header']))
+        agents = {name: checkpoint[f'agent_{name}'] for name in AGENT_FIELDS}
+        model_vars = {name[len('model_var_'):]: checkpoint[name] for name in checkpoint.files
+                      if name.startswith('model_var_')}
+        random_state = tuple(int(x) for x in checkpoint['random_state'])
+        transmissions = {name: checkpoint[f'transmission_{name}'] for name in TRANSMISSION_FIELDS
+                         if f'transmission_{name}' in checkpoint.files}
+        target_cells = checkpoint['available_target_cells']
+
+    model = CoronavirusModel(num_agents=header['num_agents'], config=config or header['config'],
+                             scenario=header['scenario'], with_interiors=header['with_interiors'],
+                             engine=header['engine'], seed=header['seed'], replicate=header['replicate'],
+                             output_dir=output_dir)
+    model.spawn_key = tuple(header['spawn_key'])
+    model.available_target_cells = target_cells
+    model.movement.set_targets(target_cells[:, 0] * model.grid.height + target_cells[:, 1])
+    restore_agents(model, agents, header['queue'])
+
+    model.going_out_prob_mean = header['going_out_prob_mean']
+    model.num_agents_allowed_outside = header['num_agents_allowed_outside']
+    model.admission.tick = header['admission_tick']
+    model.admission.admitted[...] = header['admitted']
+    model.admission.total_wait[...] = header['total_wait']
+    model.global_max_index = header['global_max_index']
+    model.schedule.steps = header['schedule_steps']
+    model.schedule.time = header['schedule_time']
+    model.running = header['running']
+    model.stop_reason = header['stop_reason']
+    model.infected_history.clear()
+    model.infected_history.extend(np.array(history) for history in header['infected_history'])
+    model.datacollector.restore(model_vars, header['steps_collected'])
+    model.rng.bit_generator.state = header['rng_state']
+    model.random.setstate((header['random_version'], random_state, header['random_gauss']))
+    model.transmission_rng.bit_generator.state = header['transmission_rng_state']
+    if model.transmissions is not None:
+        # a checkpoint without a log gives an empty one, the events so far are unknown
+        model.transmissions.restore(transmissions or {name: np.array([], dtype=dtype)
+                                                      for name, dtype in TRANSMISSION_FIELDS.items()})
+    return model
+
+
+def restore_agents(model, agents, queue):
+    """
+    Replaces the agents the model was built with by the saved ones.
+    queue: unique ids of the agents waiting to go out, in the order of the admission queue.
+    """
+    model.occupancy.fill(EMPTY_CELL)
+    if model.engine is not None:
+        engine = model.engine
+        engine.ids = agents['unique_id']
+        engine.first_id = int(engine.ids[0]) if len(engine.ids) else model.global_max_index
+        for name in AGENT_FIELDS[1:]:
+            setattr(engine, name, agents[name].copy())
+        engine.occupancy[engine.pos] = engine.ids
+        engine.count_states()
+        engine.count_outside()
+        return
+
+    for a in list(model.schedule.agents):
+        model.schedule.remove(a)
+        model.grid.remove_agent(a)
+    model.state_counts[:] = 0
+
+    for i, unique_id in enumerate(agents['unique_id']):
+        a = CoronavirusAgent(int(unique_id), model, CoronavirusAgentState(int(agents['state'][i])),
+                             home_id=agents['home_id'][i],
+                             going_out_prob=float(agents['going_out_prob'][i]))
+        a.infected_steps = int(agents['infected_steps'][i])
+        a.outside_steps = int(agents['outside_steps'][i])
+        a.max_infection_steps = int(agents['max_infection_steps'][i])
+        a.max_being_out_steps = int(agents['max_being_out_steps'][i])
+        if agents['target_index'][i] != EMPTY_CELL:
+            a.target_index = int(agents['target_index'][i])
+            a.target_cell = tuple(model.available_target_cells[a.target_index])
+        if agents['entrance'][i] != EMPTY_CELL:
+            a.entrance = int(agents['entrance'][i])
+            model.admission.enter(a.entrance)
+        model.schedule.add(a)
+        model.place_agent(a, model.cell_pos(agents['pos'][i]))
+        a.set_home_address(model.cell_pos(agents['home_cell'][i]))
+
+    for unique_id in queue:
+        a = model.schedule._agents[unique_id]
+        model.admission.join(a)
+        a.queued_since = int(agents['queued_since'][agents['unique_id'] == unique_id][0])
+
+
+def fork(model, branch):
+    """
+    Copy of the model in its current state. Every branch gets its own random
+    stream, so branches of one model diverge and branch b always continues the same way.
+    """
+    buffer = io.BytesIO()
+    save_checkpoint(model, buffer)
+    buffer.seek(0)
+    forked = load_checkpoint(buffer, config=model.config)
+    forked.setup_random(model.seed, model.spawn_key + (model.datacollector.steps_collected, branch))
+    return forked
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+
+
+class ColumnarDataCollector:
+    """
+    Collects model reporters into preallocated NumPy columns, one row per tick.
+
+    Full chunks of chunk_size rows are kept in memory or, when output_dir is
+    given, written to <output_dir>/model_vars_<n>.npz (or .parquet) and dropped,
+    so memory stays flat however long the run is. Every agent_snapshot_every
+    ticks the state of all agents is written to <output_dir>/agents_<step>.npz.
+
+    model_vars and get_model_vars_dataframe() mirror mesa's DataCollector,
+    so ChartModule can read from this collector as well.
+
+    value_shape: shape of the values returned by reporters, e.g. (replicates,)
+    for an ensemble, the data frame then has a column per value, like Infected_0.
+    """
+    def __init__(self, model_reporters, chunk_size=1000, output_dir=None, file_format='npz',
+                 agent_snapshot_every=None, value_shape=()):
+        if file_format not in ('npz', 'parquet'):
+            raise ValueError(f'Unknown file format: {file_format}')
+        self.model_reporters = model_reporters
+        self.chunk_size = chunk_size
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.agent_snapshot_every = agent_snapshot_every
+        self.value_shape = tuple(value_shape)
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+        self.steps_collected = 0
+        self.chunks = []
+        self.flushed_chunks = 0
+        self.new_chunk()
+
+    def new_chunk(self):
+        self.columns = {name: np.empty((self.chunk_size,) + self.value_shape) for name in self.model_reporters}
+        self.rows = 0
+
+    def collect(self, model):
+        for name, reporter in self.model_reporters.items():
+            self.columns[name][self.rows] = reporter(model)
+        self.rows += 1
+
+        if self.agent_snapshot_every and self.output_dir is not None and \
+                self.steps_collected % self.agent_snapshot_every == 0:
+            np.savez(os.path.join(self.output_dir, f'agents_{self.steps_collected:06d}.npz'),
+                     **model.agent_snapshot())
+        self.steps_collected += 1
+
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Moves the rows collected so far out of the current chunk."""
+        if self.rows == 0:
+            return
+        chunk = {name: column[:self.rows] for name, column in self.columns.items()}
+        if self.output_dir is None:
+            self.chunks.append(chunk)
+        else:
+            path = os.path.join(self.output_dir, f'model_vars_{self.flushed_chunks:05d}.{self.file_format}')
+            if self.file_format == 'npz':
+                np.savez(path, **chunk)
+            else:
+                to_frame(chunk).to_parquet(path)
+            self.flushed_chunks += 1
+        self.new_chunk()
+
+    def restore(self, model_vars, steps_collected):
+        """Starts over from values collected by another collector, e.g. in a checkpoint."""
+        self.chunks = [{name: np.asarray(model_vars[name], dtype=float) for name in self.model_reporters}]
+        self.steps_collected = steps_collected
+        self.new_chunk()
+
+    @property
+    def model_vars(self):
+        """Values of every reporter collected so far and not written to disk."""
+        chunks = self.chunks + [{name: column[:self.rows] for name, column in self.columns.items()}]
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in self.model_reporters}
+
+    def get_model_vars_dataframe(self):
+        # pandas is imported only for data frames, it takes longer to import than the rest of the model
+        import pandas as pd
+        frames = []
+        for i in range(self.flushed_chunks):
+            path = os.path.join(self.output_dir, f'model_vars_{i:05d}.{self.file_format}')
+            if self.file_format == 'npz':
+                with np.load(path) as chunk:
+                    frames.append(to_frame({name: chunk[name] for name in chunk.files}))
+            else:
+                frames.append(pd.read_parquet(path))
+        frames.append(to_frame(self.model_vars))
+        return pd.concat(frames, ignore_index=True)
+
+
+def to_frame(columns):
+    """Columns with many values per row are split into name_0, name_1..."""
+    import pandas as pd
+    frame = {}
+    for name, column in columns.items():
+        if column.ndim == 1:
+            frame[name] = column
+        else:
+            for i, values in enumerate(column.reshape(len(column), -1).T):
+                frame[f'{name}_{i}'] = values
+    return pd.DataFrame(frame)
@@ -1,46 +1,58 @@
-import cv2
 import numpy as np
 import argparse
-import random
 
 USAGE = "Use mouse left button to fill cells. To change id, " \
         "press n for next and p for previous. " \
         "Use c to clear. Use q to quit and save map. " \
         "Non movable space has id 0. Common space has id 1."
 
+# BGR colors of non movable space, common space and the first home
+BASE_COLORS = [(0, 0, 0), (255, 255, 255), (255, 0, 0)]
+
+
+def map_colors(num_ids, rng=None):
+    """Color of every id, as a lookup table indexed by id. Homes after the first one get random colors."""
+    rng = np.random.default_rng(rng)
+    colors = rng.integers(0, 256, size=(max(num_ids, len(BASE_COLORS)), 3), dtype=np.uint8)
+    colors[:len(BASE_COLORS)] = BASE_COLORS
+    return colors
+
+
+def draw_grid_lines(img, pixels_per_cell):
+    img[::pixels_per_cell, :] = 255
+    img[:, ::pixels_per_cell] = 255
+
+
+def render_map(grid_map, colors, pixels_per_cell, grid_lines=True):
+    """Image of the map where every cell is a pixels_per_cell square in the color of its id."""
+    cells = colors[grid_map.astype(int)]
+    img = np.kron(cells, np.ones((pixels_per_cell, pixels_per_cell, 1), dtype=np.uint8))
+    if grid_lines:
+        draw_grid_lines(img, pixels_per_cell)
+    return img
+
 
 class Map:
-    def __init__(self, grid_width, grid_height, load_path):
-        self.pixels_per_cell = 20
+    def __init__(self, grid_width, grid_height, load_path, pixels_per_cell=20):
+        self.pixels_per_cell = pixels_per_cell
         self.house_id = 1
         self.drawing = False
-        self.houses_colors = {0: (0, 0, 0), 1: (255, 255, 255), 2: (255, 0, 0)}
 
         if load_path is None:
             self.grid = np.zeros((grid_height, grid_width))
-            self.img = np.zeros((grid_height * self.pixels_per_cell,
-                                 grid_width * self.pixels_per_cell, 3),
-                                dtype=np.uint8)
         else:
             self.__load_grid(load_path)
-            self.img = np.zeros((self.grid.shape[0] * self.pixels_per_cell, self.grid.shape[1] * self.pixels_per_cell,
-                                 3), dtype=np.uint8)
-            self.__draw_initial_houses()
+        self.colors = map_colors(int(self.grid.max()) + 1)
+        self.img = render_map(self.grid, self.colors, self.pixels_per_cell)
 
     def draw_grid(self):
-        for r in range(self.img.shape[0]):
-            cv2.line(self.img, (0, r * self.pixels_per_cell),
-                     (self.img.shape[1], r * self.pixels_per_cell),
-                     (255, 255, 255))
-        for c in range(self.img.shape[1]):
-            cv2.line(self.img, (c * self.pixels_per_cell, 0),
-                     (c * self.pixels_per_cell, self.img.shape[1]),
-                     (255, 255, 255))
+        draw_grid_lines(self.img, self.pixels_per_cell)
 
     def get_img(self):
         return self.img
 
     def fill_cell(self, event, x, y, flags, params):
+        import cv2
         if event == cv2.EVENT_LBUTTONDOWN:
             self.drawing = True
             self.fill_cell(cv2.EVENT_MOUSEMOVE, x, y, flags, params)
@@ -52,17 +64,16 @@ class Map:
                 return
 
             self.grid[yp, xp] = self.house_id
-            self.img[yp * self.pixels_per_cell:(yp + 1) * self.pixels_per_cell,
-            xp * self.pixels_per_cell:(xp + 1) * self.pixels_per_cell] = \
-                self.houses_colors[self.house_id]
+            # the first row and column of pixels of a cell are grid lines
+            self.img[yp * self.pixels_per_cell + 1:(yp + 1) * self.pixels_per_cell,
+                     xp * self.pixels_per_cell + 1:(xp + 1) * self.pixels_per_cell] = \
+                self.colors[self.house_id]
         elif event == cv2.EVENT_LBUTTONUP:
             self.drawing = False
 
     def set_id(self, house_id):
-        if house_id not in self.houses_colors:
-            self.houses_colors[house_id] = (random.randint(0, 255),
-                                            random.randint(0, 255),
-                                            random.randint(0, 255))
+        if house_id >= len(self.colors):
+            self.colors = np.concatenate([self.colors, map_colors(house_id + 1)[len(self.colors):]])
         self.house_id = house_id
 
     def get_id(self):
@@ -71,31 +82,22 @@ class Map:
     def clear(self):
         self.grid.fill(0)
         self.img.fill(0)
+        self.draw_grid()
         self.drawing = False
 
     def __load_grid(self, load_path):
         self.grid = np.load(load_path)
 
-    def __draw_initial_houses(self):
-        house_number = int(self.grid.max()) + 1
-        for i in range(2, house_number + 1):
-            self.set_id(i)
-
-        for r in range(self.grid.shape[0]):
-            for c in range(self.grid.shape[1]):
-                self.img[r * self.pixels_per_cell:(r + 1) * self.pixels_per_cell,
-                         c * self.pixels_per_cell:(c + 1) * self.pixels_per_cell] = \
-                    self.houses_colors[int(self.grid[r, c])]
-
 
-def draw_map(grid_width, grid_height, save_path, load_path):
-    map = Map(grid_width, grid_height, load_path)
+def draw_map(grid_width, grid_height, save_path, load_path, pixels_per_cell=20):
+    # OpenCV is only needed by the editor window, rendering maps works without it
+    import cv2
+    map = Map(grid_width, grid_height, load_path, pixels_per_cell)
     cv2.namedWindow('map')
     cv2.setMouseCallback('map', map.fill_cell)
     while True:
         k = cv2.waitKey(1) & 0xFF
 
-        map.draw_grid()
         if k == ord('q'):
             break
         elif k == ord('n'):
@@ -120,10 +122,11 @@ def parse_arguments():
     parser.add_argument("--grid_height", default=25, type=int)
     parser.add_argument("--save_path", default="map.npy")
     parser.add_argument("--load_path", default=None)
+    parser.add_argument("--pixels_per_cell", default=20, type=int)
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     print(USAGE)
     args = parse_arguments()
-    draw_map(args.grid_width, args.grid_height, args.save_path, args.load_path)
+    draw_map(args.grid_width, args.grid_height, args.save_path, args.load_path, args.pixels_per_cell)
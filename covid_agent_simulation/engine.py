@@ -0,0 +1,269 @@
+import numpy as np
+from scipy import ndimage
+
+from .agents import CoronavirusAgentState, InteriorType, EMPTY_CELL
+
+MOORE_KERNEL = np.array([[1, 1, 1],
+                         [1, 0, 1],
+                         [1, 1, 1]])
+
+
+class VectorizedEngine:
+    """
+    Steps all agents of a CoronavirusModel at once. Instead of CoronavirusAgent
+    objects the agents are kept as a struct of arrays and cells are addressed
+    by flat indices into the model layers, i.e. x * grid height + y.
+
+    The rules are the ones of CoronavirusAgent.step, applied to everybody
+    in the same tick: agents return home, then move, then the admission
+    queue lets agents go out, and at the end infected agents recover or
+    infect their neighbours. Moves are resolved
+    in random order so that two agents never land on the same cell.
+
+    With model.replicates > 1 the engine steps that many independent copies of
+    the population on the same map: agents of replicate r are stored one
+    after another and their cells are offset by r * cells of the map, so they
+    index model.occupancy shaped (replicates, width, height) directly.
+    """
+    def __init__(self, model, min_infection_steps=10, max_infection_steps=140):
+        self.model = model
+        self.width, self.height = model.home_ids.shape
+        self.cells = self.width * self.height
+        self.replicates = model.replicates
+        # flat views on the model layers, writes to occupancy are visible in the model
+        self.home_ids = model.home_ids.ravel()
+        self.cell_types = model.cell_types.ravel()
+        self.occupancy = model.occupancy.ravel()
+        self.layers_shape = model.occupancy.shape
+
+        self.entrance_areas = self.setup_entrance_areas(model.entrance_areas)
+        self.setup_agents(min_infection_steps, max_infection_steps)
+
+    @property
+    def rng(self):
+        # looked up on every use, model.setup_random may replace the generator, e.g. in fork
+        return self.model.rng
+
+    def close(self):
+        """Nothing to free, see TiledEngine.close."""
+
+    def setup_entrance_areas(self, entrance_areas):
+        # areas have one or two cells, the single ones are repeated to make an array
+        return np.array([[self.model.cell_index(area[0]), self.model.cell_index(area[-1])]
+                         for area in entrance_areas], dtype=int).reshape(-1, 2)
+
+    def setup_agents(self, min_infection_steps, max_infection_steps):
+        model = self.model
+        home_cells = model.compiled_scenario.home_cells
+        if model.num_agents > len(home_cells):
+            model.num_agents = len(home_cells)
+            print(f'Too many agents, they cannot fit into homes. Creating just: {model.num_agents}')
+        n = model.num_agents
+
+        # make sure agents are not placed in the same cell
+        cells = np.concatenate([self.rng.choice(home_cells, size=n, replace=False)
+                                for _ in range(self.replicates)])
+        nb_infected = int(model.config['common']['initially_infected_population'] * n)
+        nb_recovered = int(model.config['common']['initially_recovered_population'] * n)
+
+        state = np.full(n, CoronavirusAgentState.HEALTHY.value, dtype=np.int8)
+        state[:nb_infected] = CoronavirusAgentState.INFECTED.value
+        state[nb_infected:nb_infected + nb_recovered] = CoronavirusAgentState.RECOVERED.value
+        self.state = np.tile(state, self.replicates)
+        self.replicate = np.repeat(np.arange(self.replicates), n)
+        self.home_id = self.home_ids[cells]
+        # agents of every replicate live in their own copy of the occupancy layer
+        cells = cells + self.replicate * self.cells
+        n = len(cells)
+
+        self.first_id = model.global_max_index
+        self.ids = np.arange(self.first_id, self.first_id + n)
+        model.global_max_index += n
+
+        self.pos = cells.copy()
+        self.home_cell = cells
+        # index into model.available_target_cells
+        self.target_index = np.full(n, EMPTY_CELL)
+        # index of the entrance agents outside went through
+        self.entrance = np.full(n, EMPTY_CELL)
+        # tick agents joined the admission queue, EMPTY_CELL if they didn't
+        self.queued_since = np.full(n, EMPTY_CELL)
+        self.infected_steps = np.zeros(n, dtype=int)
+        self.outside_steps = np.zeros(n, dtype=int)
+        self.max_infection_steps = self.rng.integers(min_infection_steps, max_infection_steps, n, endpoint=True)
+        max_time_outside = model.config['environment'][model.scenario]['max_time_outside']
+        self.max_being_out_steps = self.rng.integers(5, max_time_outside, n, endpoint=True)
+        mu = model.going_out_prob_mean
+        self.going_out_prob = np.clip(self.rng.normal(mu, mu / 2, n), 0, 1)
+
+        self.occupancy[cells] = self.ids
+        self.count_states()
+        self.count_outside()
+
+    def count_states(self):
+        states = self.model.state_counts.shape[-1]
+        counts = np.bincount(self.replicate * states + self.state, minlength=self.replicates * states)
+        self.model.state_counts[:] = counts.reshape(self.model.state_counts.shape)
+
+    def count_outside(self):
+        """Agents outside by entrance and agents waiting in the queue, see AdmissionQueue."""
+        admission = self.model.admission
+        entrances = admission.occupancy.shape[-1]
+        outside = np.flatnonzero(self.entrance != EMPTY_CELL)
+        counts = np.bincount(self.replicate[outside] * entrances + self.entrance[outside],
+                             minlength=self.replicates * entrances)
+        admission.occupancy[:] = counts.reshape(admission.occupancy.shape)
+        queued = self.queued_since != EMPTY_CELL
+        admission.queue_length[...] = np.bincount(self.replicate[queued], minlength=self.replicates
+                                                  ).reshape(admission.queue_length.shape)
+
+    def agent_snapshot(self):
+        x, y = np.divmod(self.pos % self.cells, self.height)
+        snapshot = {'unique_id': self.ids, 'x': x, 'y': y, 'state': self.state.copy()}
+        if self.replicates > 1:
+            snapshot['replicate'] = self.replicate
+        return snapshot
+
+    def step(self):
+        n = len(self.pos)
+        at_home = self.cell_types[self.pos % self.cells] == InteriorType.HOME.value
+        outside = ~at_home
+
+        admission = self.model.admission
+        wants_out = at_home & (self.rng.random(n) < self.going_out_prob)
+        self.queued_since[wants_out & (self.queued_since == EMPTY_CELL)] = admission.tick
+        returning = np.flatnonzero(outside & (self.outside_steps > self.max_being_out_steps))
+        # agents coming back home make room for the ones in the queue
+        free_slots = np.maximum(self.model.num_agents_allowed_outside -
+                                np.bincount(self.replicate[outside], minlength=self.replicates) +
+                                np.bincount(self.replicate[returning], minlength=self.replicates), 0)
+        going_out = self.admit(self.queue(), free_slots)
+
+        moving = np.ones(n, dtype=bool)
+        moving[going_out] = False
+        moving[returning] = False
+        self.outside_steps[moving & outside] += 1
+
+        profiler = self.model.profiler
+        with profiler.phase('return_home'):
+            self.return_home(returning)
+        with profiler.phase('move'):
+            self.move(np.flatnonzero(moving))
+        with profiler.phase('go_out'):
+            went_out = self.go_out(going_out)
+            admission.record_admitted(admission.tick - self.queued_since[went_out], self.replicate[went_out])
+            self.queued_since[went_out] = EMPTY_CELL
+        with profiler.phase('infection'):
+            self.update_infections()
+        self.count_states()
+        self.count_outside()
+        admission.next_tick()
+
+    def queue(self):
+        """Agents in the admission queue, the ones that waited the longest first, in random order within a tick."""
+        queued = self.rng.permutation(np.flatnonzero(self.queued_since != EMPTY_CELL))
+        return queued[np.argsort(self.queued_since[queued], kind='stable')]
+
+    def admit(self, candidates, free_slots):
+        """The first free_slots[r] candidates of every replicate r."""
+        replicate = self.replicate[candidates]
+        counts = np.bincount(replicate, minlength=self.replicates)
+        order = np.argsort(replicate, kind='stable')
+        rank = np.empty(len(candidates), dtype=int)
+        rank[order] = np.arange(len(candidates)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return candidates[rank < free_slots[replicate]]
+
+    def return_home(self, agents):
+        self.outside_steps[agents] = 0
+        self.entrance[agents] = EMPTY_CELL
+        for i in agents:
+            cell = self.home_cell[i]
+            if self.occupancy[cell] != EMPTY_CELL:
+                # a housemate stands on our cell, there is always another free one at home
+                home = self.model.compiled_scenario.cells_of_home(self.home_id[i]) + cell - cell % self.cells
+                cell = home[self.occupancy[home] == EMPTY_CELL][0]
+            self.relocate(np.array([i]), np.array([cell]))
+
+    def go_out(self, agents):
+        """Returns the agents that went out, the other ones stay in the queue."""
+        if len(agents) == 0 or len(self.entrance_areas) == 0:
+            return agents[:0]
+        entrance = self.rng.integers(len(self.entrance_areas), size=len(agents))
+        cells = self.entrance_areas[entrance, self.rng.integers(2, size=len(agents))] + \
+            self.replicate[agents] * self.cells
+        admitted = (self.occupancy[cells] == EMPTY_CELL) & first_claims(cells)
+        agents, cells = agents[admitted], cells[admitted]
+        self.target_index[agents] = self.rng.integers(len(self.model.available_target_cells), size=len(agents))
+        self.entrance[agents] = entrance[admitted]
+        self.relocate(agents, cells)
+        return agents
+
+    def move(self, agents):
+        if len(agents) == 0:
+            return
+        agents = self.rng.permutation(agents)
+        pos = self.pos[agents] % self.cells
+        tables = self.model.movement
+
+        # agents walk inside their own home or in the common space
+        candidates = tables.neighbors[pos]
+        # the same cells in the occupancy layer of the replicate of every agent
+        steps = candidates + (self.replicate[agents] * self.cells)[:, None]
+        self.model.profiler.count('neighbor_queries', len(agents))
+        valid = tables.walkable[pos] & (self.occupancy[steps] == EMPTY_CELL)
+
+        # prefer cells where there are fever agents around
+        occupied = (self.occupancy != EMPTY_CELL).reshape(self.layers_shape)
+        kernel = MOORE_KERNEL.reshape((1,) * (occupied.ndim - 2) + MOORE_KERNEL.shape)
+        crowd = ndimage.convolve(occupied.astype(int), kernel, mode='constant').ravel()
+        moore_max_objects = 8
+        scores = 1 - crowd[steps] / moore_max_objects
+
+        # prefer cells that minimize distance to target cell
+        targets = self.target_index[agents]
+        distance = tables.target_distance[targets[:, None], candidates]
+        scores += np.where((targets[:, None] != EMPTY_CELL) & (distance > 0), 1 / np.maximum(distance, 1), 0)
+
+        # there are usually more than one cell with the same score, pick one of them at random
+        scores = np.where(valid, scores, -np.inf)
+        top = valid & (scores == scores.max(axis=1)[:, None])
+        choice = np.argmax(top * self.rng.random(top.shape), axis=1)
+
+        can_move = valid.any(axis=1)
+        agents = agents[can_move]
+        steps = steps[can_move, choice[can_move]]
+        # agents were shuffled, so the first one claiming a cell is a random one
+        winners = first_claims(steps)
+        self.relocate(agents[winners], steps[winners])
+
+    def relocate(self, agents, cells):
+        self.occupancy[self.pos[agents]] = EMPTY_CELL
+        self.occupancy[cells] = self.ids[agents]
+        self.pos[agents] = cells
+
+    def update_infections(self):
+        infected = np.flatnonzero(self.state == CoronavirusAgentState.INFECTED.value)
+        recovering = self.infected_steps[infected] >= self.max_infection_steps[infected]
+        self.state[infected[recovering]] = CoronavirusAgentState.RECOVERED.value
+        spreading = infected[~recovering]
+        self.infected_steps[spreading] += 1
+        self.infect(spreading)
+
+    def infect(self, sources):
+        infectious = np.bincount(self.pos[sources], minlength=len(self.occupancy))
+        pressure = self.model.infection_kernel.pressure(infectious.reshape(self.layers_shape)).ravel()
+        healthy = np.flatnonzero(self.state == CoronavirusAgentState.HEALTHY.value)
+        hit = self.rng.random(len(healthy)) < pressure[self.pos[healthy]]
+        targets = healthy[hit]
+        self.state[targets] = CoronavirusAgentState.INFECTED.value
+        if self.model.transmissions is not None and len(targets):
+            self.model.log_transmissions(self.pos[sources], self.ids[sources], self.pos[targets], self.ids[targets],
+                                         self.replicate[targets])
+
+
+def first_claims(cells):
+    """Marks the first occurrence of every cell, the others lose the claim."""
+    _, first = np.unique(cells, return_index=True)
+    claims = np.zeros(len(cells), dtype=bool)
+    claims[first] = True
+    return claims
@@ -0,0 +1,74 @@
+"""
+Runs many replicates of one scenario at once, in a single model.
+
+    python -m covid_agent_simulation.ensemble --scenario park --num_agents 100 --replicates 50 --steps 300
+
+The replicates are an extra dimension of the arrays of the vectorized engine
+(agent state is replicates x agents, occupancy replicates x width x height),
+while the map layers, movement tables and target cells are built once and
+shared by all of them. All replicates draw from the random stream of the
+model, so replicate r of an ensemble is not the same run as a model with replicate=r.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from .model import CoronavirusModel
+from .utils import get_config
+
+QUANTILES = (0.05, 0.5, 0.95)
+
+
+def run_ensemble(config, scenario, num_agents, replicates, steps, going_out_prob_mean=0.05, seed=None,
+                 profile=False):
+    """
+    Returns the model and its curves, for every reporter a (steps + 1, replicates) array.
+    profile: time the phases of every tick, see model.profiler.summary().
+    """
+    model = CoronavirusModel(num_agents=num_agents, config=config, scenario=scenario,
+                             going_out_prob_mean=going_out_prob_mean, with_interiors=False,
+                             engine='vectorized', seed=seed, replicates=replicates, profile=profile)
+    model.run_model(steps)
+    curves = {name: values.reshape(len(values), -1) for name, values in model.datacollector.model_vars.items()}
+    return model, curves
+
+
+def aggregate_curves(curves, quantiles=QUANTILES):
+    """
+    Mean and quantiles over replicates of every curve, one row per step
+    and columns like ('Infected', 'mean') or ('Infected', 'q0.95').
+    """
+    frame = {}
+    for name, values in curves.items():
+        frame[(name, 'mean')] = values.mean(axis=1)
+        for q, row in zip(quantiles, np.quantile(values, quantiles, axis=1)):
+            frame[(name, f'q{q:g}')] = row
+    return pd.DataFrame(frame).rename_axis('step')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=None, help="yml config, configs/designed_shapes.yml if not given")
+    parser.add_argument("--scenario", default="store")
+    parser.add_argument("--num_agents", default=100, type=int)
+    parser.add_argument("--going_out_prob_mean", default=0.5, type=float)
+    parser.add_argument("--seed", default=None, type=int)
+    parser.add_argument("--replicates", default=20, type=int)
+    parser.add_argument("--steps", default=200, type=int)
+    parser.add_argument("--quantiles", nargs='+', type=float, default=list(QUANTILES))
+    parser.add_argument("--output", default=None, help="csv file for the aggregated curves")
+    parser.add_argument("--profile", action='store_true', help="print the time spent in every phase of a tick")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    model, curves = run_ensemble(get_config(args.config), args.scenario, args.num_agents, args.replicates,
+                                 args.steps, args.going_out_prob_mean, args.seed, args.profile)
+    aggregated = aggregate_curves(curves, args.quantiles)
+    if args.output is not None:
+        aggregated.to_csv(args.output)
+    print(aggregated.iloc[::max(args.steps // 20, 1)].round(2).to_string())
+    if args.profile:
+        print(model.profiler.summary())
@@ -0,0 +1,248 @@
+"""
+Maps outcomes of the model over a parameter space with as few runs as possible.
+
+    python -m covid_agent_simulation.explore --space space.yml --initial_runs 20 --rounds 10 --runs_per_round 4
+
+A space gives a [min, max] range for numeric parameters and a list of names
+for the scenario, e.g.
+
+    scenario: [store, park]
+    num_agents: [10, 100]
+    going_out_prob_mean: [0.05, 1.0]
+    num_agents_allowed: [1, 20]
+    max_time_outside: [5, 40]
+    infection_scale: [0.25, 1.5]
+
+infection_scale multiplies the infection_probabilities of the config.
+An initial latin hypercube design is run first, then in every round a
+Gaussian process is fitted to peak infected and time to peak of all runs so
+far and new runs are placed where the surrogate is the least certain. Failed
+runs are listed with their error, like in batch.py, and left out of the fit. Every
+run is cached under a digest of its config, parameters, seed and steps in
+<output_dir>/cache, so explorations of overlapping spaces reuse each other's runs.
+"""
+import argparse
+import copy
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import yaml
+
+from .batch import run_replicate
+from .cache import ResultCache, file_digest, json_digest
+from .utils import get_config
+
+DEFAULT_SPACE = {'scenario': ['store', 'park', 'forest'],
+                 'num_agents': [10, 100],
+                 'going_out_prob_mean': [0.05, 1.0],
+                 'num_agents_allowed': [1, 20],
+                 'max_time_outside': [5, 40],
+                 'infection_scale': [0.25, 1.5]}
+INTEGER_PARAMETERS = ['num_agents', 'num_agents_allowed', 'max_time_outside']
+TARGETS = ['peak_infected', 'time_to_peak']
+
+
+class ParameterSpace:
+    """Maps parameters to points of the unit cube and back, scenarios are one-hot encoded."""
+    def __init__(self, space):
+        self.scenarios = list(space.get('scenario', ['store']))
+        self.ranges = {name: value for name, value in space.items() if name != 'scenario'}
+
+    @property
+    def dimensions(self):
+        return len(self.ranges) + 1
+
+    def decode(self, unit):
+        """unit: point of the unit cube, the last coordinate picks the scenario."""
+        params = {'scenario': self.scenarios[min(int(unit[-1] * len(self.scenarios)), len(self.scenarios) - 1)]}
+        for u, (name, (low, high)) in zip(unit, self.ranges.items()):
+            value = low + u * (high - low)
+            params[name] = int(round(value)) if name in INTEGER_PARAMETERS else float(value)
+        return params
+
+    def encode(self, params):
+        """Features of the surrogate."""
+        features = [(params[name] - low) / (high - low) if high > low else 0.
+                    for name, (low, high) in self.ranges.items()]
+        features += [float(params['scenario'] == scenario) for scenario in self.scenarios]
+        return np.array(features)
+
+    def latin_hypercube(self, rng, n):
+        strata = np.stack([rng.permutation(n) for _ in range(self.dimensions)], axis=1)
+        units = (strata + rng.random((n, self.dimensions))) / n
+        return [self.decode(unit) for unit in units]
+
+    def sample(self, rng, n):
+        return [self.decode(unit) for unit in rng.random((n, self.dimensions))]
+
+
+class GaussianProcess:
+    """
+    Gaussian process regression with an RBF kernel on standardized targets.
+    The length scale and the noise are picked from a grid by the marginal likelihood,
+    runs of the model are noisy, so the noise is never zero.
+    """
+    def __init__(self, length_scales=(0.1, 0.2, 0.4, 0.8, 1.6), noises=(1e-3, 1e-2, 1e-1, 0.3)):
+        self.length_scales = length_scales
+        self.noises = noises
+
+    def kernel(self, a, b):
+        squared = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=-1)
+        return np.exp(-0.5 * squared / self.length_scale ** 2)
+
+    def fit(self, x, y, hyperparameters=None):
+        """hyperparameters: (length scale, noise) to use instead of searching for them."""
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.y_mean, self.y_std = self.y.mean(), max(self.y.std(), 1e-9)
+        z = (self.y - self.y_mean) / self.y_std
+
+        best = None
+        for length_scale, noise in ([hyperparameters] if hyperparameters else
+                                    [(l, n) for l in self.length_scales for n in self.noises]):
+            self.length_scale = length_scale
+            chol = np.linalg.cholesky(self.kernel(self.x, self.x) + noise * np.eye(len(self.x)))
+            alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, z))
+            log_likelihood = -0.5 * z @ alpha - np.log(np.diag(chol)).sum()
+            if best is None or log_likelihood > best[0]:
+                best = (log_likelihood, length_scale, noise, chol, alpha)
+        _, self.length_scale, self.noise, self.chol, self.alpha = best
+        return self
+
+    @property
+    def hyperparameters(self):
+        return self.length_scale, self.noise
+
+    def predict(self, x):
+        """Mean and standard deviation, in units of the targets."""
+        cross = self.kernel(np.asarray(x, dtype=float), self.x)
+        mean = cross @ self.alpha
+        v = np.linalg.solve(self.chol, cross.T)
+        variance = np.maximum(1 - (v ** 2).sum(axis=0), 0)
+        return self.y_mean + self.y_std * mean, self.y_std * np.sqrt(variance)
+
+
+def apply_parameters(config, params):
+    """Config with the parameters of a point that are not arguments of the model."""
+    config = copy.deepcopy(config)
+    environment = config['environment'][params['scenario']]
+    for name in ['num_agents_allowed', 'max_time_outside']:
+        if name in params:
+            environment[name] = params[name]
+    if 'infection_scale' in params:
+        config['common']['infection_probabilities'] = [
+            min(p * params['infection_scale'], 1.) for p in config['common']['infection_probabilities']]
+    return config
+
+
+def run_point(config, params, steps, engine, seed):
+    run = {'scenario': params['scenario'], 'num_agents': params.get('num_agents', 10),
+           'going_out_prob_mean': params.get('going_out_prob_mean', 0.5),
+           'seed': seed, 'replicate': None, 'run_id': None}
+    summary = run_replicate(apply_parameters(config, params), run, steps, engine)
+    return {name: summary[name] for name in TARGETS}
+
+
+def run_key(config, params, steps, engine, seed):
+    run_config = apply_parameters(config, params)
+    map_path = run_config['environment'][params['scenario']]['map_path']
+    return json_digest({'config': run_config, 'map': file_digest(map_path), 'params': params,
+                        'steps': steps, 'engine': engine, 'seed': seed})
+
+
+def select_runs(surrogates, space, rng, n, candidates):
+    """
+    Points where the surrogates are the least certain. After each pick the
+    surrogates believe their own prediction there, so the next pick goes elsewhere
+    (the surrogates are refitted in place).
+    """
+    pool = space.sample(rng, candidates)
+    features = np.array([space.encode(params) for params in pool])
+    selected, uncertainty = [], []
+    for _ in range(n):
+        stds = np.array([surrogate.predict(features)[1] / surrogate.y_std for surrogate in surrogates])
+        best = int(np.argmax(stds.sum(axis=0)))
+        selected.append(pool[best])
+        uncertainty.append(float(stds[:, best].sum()))
+        for surrogate in surrogates:
+            believed = surrogate.predict(features[best:best + 1])[0]
+            surrogate.fit(np.vstack([surrogate.x, features[best]]), np.append(surrogate.y, believed),
+                          surrogate.hyperparameters)
+    return selected, uncertainty
+
+
+def explore(config, space, steps, initial_runs, rounds, runs_per_round, output_dir,
+            engine='vectorized', seed=None, workers=None, candidates=2000):
+    """Returns the results of all runs and the surrogates fitted to them, one per target."""
+    seed = config['common']['random_seed'] if seed is None else seed
+    rng = np.random.default_rng(seed)
+    cache = ResultCache(os.path.join(output_dir, 'cache'))
+    results = []
+
+    points = space.latin_hypercube(rng, initial_runs)
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            open(os.path.join(output_dir, 'explored.jsonl'), 'a') as explored:
+        for round_index in range(rounds + 1):
+            keys = [run_key(config, params, steps, engine, seed) for params in points]
+            cached = [cache.get(key) for key in keys]
+            futures = {i: executor.submit(run_point, config, params, steps, engine, seed)
+                       for i, params in enumerate(points) if cached[i] is None}
+            for i, params in enumerate(points):
+                outcome = cached[i]
+                if outcome is None:
+                    try:
+                        outcome = futures[i].result()
+                    except Exception as err:
+                        # a failed run is recorded, the exploration goes on without it
+                        outcome = {'error': repr(err)}
+                        print(f'run {params} failed: {err!r}')
+                    else:
+                        cache.put(keys[i], outcome)
+                result = dict(params, round=round_index, cached=cached[i] is not None, **outcome)
+                results.append(result)
+                explored.write(json.dumps(result) + '\n')
+            explored.flush()
+
+            fitted = [result for result in results if 'error' not in result]
+            if not fitted:
+                raise RuntimeError('All runs failed, see explored.jsonl')
+            features = np.array([space.encode(result) for result in fitted])
+            surrogates = [GaussianProcess().fit(features, [result[target] for result in fitted])
+                          for target in TARGETS]
+            if round_index == rounds:
+                break
+            points, uncertainty = select_runs(surrogates, space, rng, runs_per_round, candidates)
+            print(f'round {round_index + 1}/{rounds}: {len(results)} runs ({len(futures)} new), '
+                  f'highest uncertainty {uncertainty[0]:.2f}')
+    return results, surrogates
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=None, help="yml config, configs/designed_shapes.yml if not given")
+    parser.add_argument("--space", default=None, help="yml file with the explored parameters")
+    parser.add_argument("--initial_runs", default=20, type=int)
+    parser.add_argument("--rounds", default=10, type=int)
+    parser.add_argument("--runs_per_round", default=4, type=int)
+    parser.add_argument("--steps", default=200, type=int)
+    parser.add_argument("--engine", default="vectorized", choices=['mesa', 'vectorized'])
+    parser.add_argument("--seed", default=None, type=int)
+    parser.add_argument("--workers", default=None, type=int)
+    parser.add_argument("--output_dir", default="explore_results")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    space = DEFAULT_SPACE
+    if args.space is not None:
+        with open(args.space, 'r') as f:
+            space = yaml.safe_load(f)
+    os.makedirs(args.output_dir, exist_ok=True)
+    results, surrogates = explore(get_config(args.config), ParameterSpace(space), args.steps, args.initial_runs,
+                                  args.rounds, args.runs_per_round, args.output_dir, args.engine, args.seed,
+                                  args.workers)
+    for target, surrogate in zip(TARGETS, surrogates):
+        print(f'{target}: length scale {surrogate.length_scale}, noise {surrogate.noise}')
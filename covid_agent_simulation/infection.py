@@ -0,0 +1,98 @@
+import math
+
+import numpy as np
+from scipy import ndimage
+
+
+def infection_kernel(probabilities):
+    """
+    Probability of infecting an agent at each offset from an infected one.
+    The offset at moore distance d (floored euclidean distance) gets
+    probabilities[d - 1], offsets further than len(probabilities) get 0.
+    """
+    radius = len(probabilities)
+    kernel = np.zeros((2 * radius + 1, 2 * radius + 1))
+    for dx in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            distance = math.floor(math.sqrt(dx ** 2 + dy ** 2))
+            if 0 < distance <= radius:
+                kernel[dx + radius, dy + radius] = probabilities[distance - 1]
+    return kernel
+
+
+class InfectionKernel:
+    """
+    Computes the infection pressure of all infected agents at once.
+
+    Agents only infect each other when they are in the same home or both
+    in the common space, so the map is split into channels by home id and
+    every channel is convolved separately over its bounding box. Every
+    source is an independent chance of infection, so the convolution runs
+    over log(1 - p) and the probability of getting infected in a cell is
+    1 - prod(1 - p) of all sources around it.
+    """
+    def __init__(self, home_ids, probabilities):
+        self.home_ids = home_ids
+        self.kernel = infection_kernel(probabilities)
+        # a probability of 1 would give log(0), it only has to be certain enough
+        self.log_escape = np.log1p(-np.clip(self.kernel, 0, 1 - 1e-12))
+        # bounding box of every home id, entry i is for home id i + 1
+        self.regions = ndimage.find_objects(home_ids.astype(int))
+
+    def pressure(self, sources):
+        """
+        sources: number of infected agents in each cell, shaped like home_ids
+        or (..., width, height) for many independent layers, e.g. replicates.
+        Returns the probability of getting infected for an agent in each cell.
+        """
+        log_escape = np.zeros(sources.shape)
+        # the layers are convolved at once, but never mixed
+        kernel = self.log_escape.reshape((1,) * (sources.ndim - 2) + self.log_escape.shape)
+        infected_cells = (sources > 0).reshape((-1,) + self.home_ids.shape).any(axis=0)
+        for channel in np.unique(self.home_ids[infected_cells]):
+            region = (Ellipsis,) + self.regions[channel - 1]
+            mask = self.home_ids[region[1:]] == channel
+            channel_sources = np.where(mask, sources[region], 0).astype(float)
+            # basic slicing gives a view, so this writes into log_escape
+            log_escape[region][..., mask] = ndimage.convolve(channel_sources, kernel, mode='constant')[..., mask]
+        return -np.expm1(log_escape)
+
+    def attribute(self, source_cells, target_cells, rng):
+        """
+        Picks the source of every infection among the sources around its target,
+        each with a chance proportional to -log(1 - p), its share of the log(1 - p)
+        summed up by pressure().
+        source_cells, target_cells: flat cells of the infected agents, one per agent,
+        and of the agents they infected. For many layers cells are offset by the layer,
+        like in a raveled (..., width, height) array.
+        Returns the index into source_cells of the source of every target and the
+        moore distance band between them.
+        """
+        width, height = self.home_ids.shape
+        home_ids = self.home_ids.ravel()
+        radius = self.kernel.shape[0] // 2
+        dx, dy = np.nonzero(self.kernel > 0)
+        hazards = -self.log_escape[dx, dy]
+        dx, dy = dx - radius, dy - radius
+
+        order = np.argsort(source_cells, kind='stable')
+        sorted_cells = source_cells[order]
+        local = target_cells % home_ids.size
+        x, y = np.divmod(local, height)
+        x, y = x[:, None] + dx, y[:, None] + dy
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        candidates = np.where(inside, x * height + y, 0)
+        # like in pressure(), only sources of the same channel count
+        same_channel = inside & (home_ids[candidates] == home_ids[local][:, None])
+        candidates += (target_cells - local)[:, None]
+        first = np.searchsorted(sorted_cells, candidates, side='left')
+        counts = np.where(same_channel, np.searchsorted(sorted_cells, candidates, side='right') - first, 0)
+
+        cumulative = np.cumsum(counts * hazards, axis=1)
+        draws = rng.random((2, len(target_cells)))
+        offset = np.count_nonzero(cumulative <= (draws[0] * cumulative[:, -1])[:, None], axis=1)
+        targets = np.arange(len(target_cells))
+        # one of the sources standing in the picked cell
+        picked = first[targets, offset] + (draws[1] * counts[targets, offset]).astype(int)
+        distance = np.floor(np.sqrt(dx ** 2 + dy ** 2)).astype(int)[offset]
+        return order[picked], distance
@@ -0,0 +1,116 @@
+import json
+import time
+from collections import defaultdict
+
+
+class PhaseProfiler:
+    """
+    Records wall time and number of calls of every phase of a tick
+    (go_out, move, return_home, infection, collect...) and event counters
+    like the number of neighbour queries.
+
+    Phases are timed with `with profiler.phase('move'):`, a tick is closed
+    with end_tick(), which adds a row to the table returned by get_table().
+    """
+    enabled = True
+
+    def __init__(self):
+        self.tick = 0
+        self.rows = []
+        self.trace_events = []
+        self.start_time = time.perf_counter()
+        self.reset_tick()
+
+    def reset_tick(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.first_start = {}
+        self.counters = defaultdict(int)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add(self, name, start, end):
+        self.times[name] += end - start
+        self.calls[name] += 1
+        self.first_start.setdefault(name, start)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def end_tick(self):
+        row = {'step': self.tick}
+        for name in self.times:
+            row[f'{name}_time'] = self.times[name]
+            row[f'{name}_calls'] = self.calls[name]
+            # phases called once per agent are merged into one span per tick
+            self.trace_events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': name,
+                                      'ts': (self.first_start[name] - self.start_time) * 1e6,
+                                      'dur': self.times[name] * 1e6,
+                                      'args': {'calls': self.calls[name], 'step': self.tick}})
+        row.update(self.counters)
+        self.rows.append(row)
+        self.tick += 1
+        self.reset_tick()
+
+    def get_table(self):
+        # like in ColumnarDataCollector, pandas is only imported for tables
+        import pandas as pd
+        return pd.DataFrame(self.rows).fillna(0).set_index('step')
+
+    def summary(self):
+        """Total, per tick and per call time of every phase."""
+        import pandas as pd
+        table = self.get_table()
+        phases = [column[:-len('_time')] for column in table.columns if column.endswith('_time')]
+        summary = pd.DataFrame({
+            'total_time': [table[f'{name}_time'].sum() for name in phases],
+            'time_per_tick': [table[f'{name}_time'].mean() for name in phases],
+            'calls': [table[f'{name}_calls'].sum() for name in phases],
+        }, index=phases)
+        summary['time_per_call'] = summary['total_time'] / summary['calls']
+        return summary.sort_values('total_time', ascending=False)
+
+    def dump_chrome_trace(self, path):
+        """The file can be opened in chrome://tracing or https://ui.perfetto.dev"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+class NullProfiler:
+    """Used when profiling is off, every call is a no-op."""
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def count(self, name, n=1):
+        pass
+
+    def end_tick(self):
+        pass
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, self.start, time.perf_counter())
+
+
+class _NullPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
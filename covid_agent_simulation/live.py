@@ -0,0 +1,135 @@
+"""
+A ModularServer whose model doesn't wait for the browser.
+
+The model is stepped at full speed in a background thread and the page
+only subscribes to frames, pushed to every open websocket at most
+frame_rate times per second. Start on the page starts the simulation,
+Stop pauses the background thread until Start is pressed again,
+Reset stops it and builds a new model. Charts get one point per frame,
+so long runs are down-sampled.
+"""
+import asyncio
+import threading
+
+import tornado.escape
+import tornado.ioloop
+from mesa.visualization.ModularVisualization import ModularServer, SocketHandler, VisualizationElement
+
+
+class SimulationThread(threading.Thread):
+    """Steps the model until it stops running, max_steps or stop()."""
+    def __init__(self, model, max_steps):
+        super().__init__(daemon=True)
+        self.model = model
+        self.max_steps = max_steps
+        # held while stepping, so that frames never see a half-done tick
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # cleared while the simulation is paused, the thread waits for it instead of stepping
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.steps = 0
+
+    def run(self):
+        while True:
+            self.resumed.wait()
+            if self.stopped.is_set() or self.finished:
+                return
+            with self.lock:
+                self.model.step()
+                self.steps += 1
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def stop(self):
+        self.stopped.set()
+        # wakes a paused thread up, so that it sees it was stopped
+        self.resumed.set()
+        if self.is_alive():
+            self.join()
+
+    @property
+    def finished(self):
+        return not self.model.running or self.steps >= self.max_steps
+
+
+class LiveControl(VisualizationElement):
+    """Tells the server when Start and Stop are pressed on the page, the stock page only stops asking for steps."""
+    js_code = 'playPauseButton.on("click", function() { send({"type": control.running ? "start" : "stop"}); });'
+
+    def render(self, model):
+        return None
+
+
+class LiveSocketHandler(SocketHandler):
+    def open(self):
+        super().open()
+        self.application.subscribers.add(self)
+
+    def on_close(self):
+        self.application.subscribers.discard(self)
+
+    def on_message(self, message):
+        msg = tornado.escape.json_decode(message)
+        if msg["type"] == "get_step":
+            # the page asks for steps while it plays, frames are pushed anyway
+            self.application.start_simulation()
+        elif msg["type"] == "start":
+            self.application.start_simulation()
+            self.application.simulation.resume()
+        elif msg["type"] == "stop":
+            self.application.simulation.pause()
+        elif msg["type"] == "reset":
+            self.application.reset_model()
+            self.write_message(self.viz_state_message)
+        else:
+            super().on_message(message)
+
+
+class LiveServer(ModularServer):
+    socket_handler = (r'/ws', LiveSocketHandler)
+    handlers = [ModularServer.page_handler, socket_handler, ModularServer.static_handler,
+                ModularServer.local_handler]
+
+    def __init__(self, model_cls, visualization_elements, name="Mesa Model", model_params={}, frame_rate=10):
+        self.frame_rate = frame_rate
+        self.subscribers = set()
+        self.simulation = None
+        # last, the page renders the elements by their index
+        super().__init__(model_cls, list(visualization_elements) + [LiveControl()], name, model_params)
+
+    def reset_model(self):
+        if self.simulation is not None:
+            self.simulation.stop()
+        super().reset_model()
+        self.simulation = SimulationThread(self.model, self.max_steps)
+        self.rendered_steps = 0
+
+    def start_simulation(self):
+        if not self.simulation.is_alive() and not self.simulation.finished:
+            self.simulation.start()
+
+    def render_model(self):
+        with self.simulation.lock:
+            self.rendered_steps = self.simulation.steps
+            return super().render_model()
+
+    async def push_frames(self):
+        while True:
+            await asyncio.sleep(1 / self.frame_rate)
+            simulation = self.simulation
+            if not self.subscribers or simulation.steps == self.rendered_steps:
+                continue
+            message = {"type": "viz_state", "data": self.render_model()}
+            for subscriber in list(self.subscribers):
+                subscriber.write_message(message)
+                if simulation.finished and self.rendered_steps == simulation.steps:
+                    subscriber.write_message({"type": "end"})
+
+    def launch(self, port=None):
+        tornado.ioloop.IOLoop.current().spawn_callback(self.push_frames)
+        super().launch(port)
@@ -0,0 +1,115 @@
+"""
+Generates city-scale maps in the format of draw_map.py, to try the model on large maps.
+
+    python -m covid_agent_simulation.map_generator --rows 500 --cols 800 --save_path city_map.npy --preview city_map.png --config city.yml
+
+The city is a grid of streets (common space) around blocks. A block is a park
+(common space) with probability park_fraction, otherwise it is split into lots,
+homes with a wall below and on the right of them. A lot is a home with
+probability home_density and unreachable space otherwise. The size of homes
+is drawn for every block from home_size. Entrances are random street cells.
+--config writes the environment section of the config for the map.
+"""
+import argparse
+
+import numpy as np
+import yaml
+
+from .agents import InteriorType
+from .draw_map import map_colors, render_map
+
+
+def block_axis(length, block_size, street_width):
+    """Block of every cell along an axis and its position in the block, negative on streets."""
+    period = block_size + street_width
+    cells = np.arange(length)
+    blocks = cells // period
+    # cells of blocks cut off by the edge of the map
+    extents = np.minimum(block_size, length - blocks * period - street_width)
+    return blocks, cells % period - street_width, extents
+
+
+def generate_map(rows, cols, block_size=12, street_width=2, home_size=(3, 5), home_density=0.8,
+                 park_fraction=0.1, num_entrances=4, seed=None):
+    """
+    Returns the map, rows from the top, and the entrance cells as [row, column] of the map.
+    home_size: the smallest and the largest side of a home.
+    """
+    rng = np.random.default_rng(seed)
+    block_rows, row_offsets, row_extents = [a[:, None] for a in block_axis(rows, block_size, street_width)]
+    block_cols, col_offsets, col_extents = [a[None, :] for a in block_axis(cols, block_size, street_width)]
+    num_blocks = (block_rows[-1, 0] + 1, block_cols[0, -1] + 1)
+
+    home_rows = rng.integers(home_size[0], home_size[1] + 1, size=num_blocks)[block_rows, block_cols]
+    home_cols = rng.integers(home_size[0], home_size[1] + 1, size=num_blocks)[block_rows, block_cols]
+    parks = (rng.random(num_blocks) < park_fraction)[block_rows, block_cols]
+    streets = (row_offsets < 0) | (col_offsets < 0)
+
+    lot_rows, lot_cols = row_offsets // (home_rows + 1), col_offsets // (home_cols + 1)
+    homes = (~streets & ~parks
+             & (row_offsets % (home_rows + 1) < home_rows) & (col_offsets % (home_cols + 1) < home_cols)
+             # lots that don't fit in the block are left out
+             & (lot_rows * (home_rows + 1) + home_rows <= row_extents)
+             & (lot_cols * (home_cols + 1) + home_cols <= col_extents))
+
+    lots = ((block_rows * num_blocks[1] + block_cols) * block_size + lot_rows) * block_size + lot_cols
+    lot_ids, lot_of_cell = np.unique(lots[homes], return_inverse=True)
+    built = rng.random(len(lot_ids)) < home_density
+    home_ids = np.where(built, np.cumsum(built) - 1 + InteriorType.HOME.value, InteriorType.UNREACHABLE.value)
+
+    grid_map = np.full((rows, cols), InteriorType.UNREACHABLE.value, dtype=float)
+    grid_map[streets | parks] = InteriorType.COMMON_SPACE.value
+    grid_map[homes] = home_ids[lot_of_cell]
+
+    street_cells = np.argwhere(streets)
+    entrances = street_cells[rng.choice(len(street_cells), size=min(num_entrances, len(street_cells)),
+                                        replace=False)]
+    return grid_map, sorted(entrances.tolist())
+
+
+def save_preview(path, grid_map, pixels_per_cell=2, seed=None):
+    # only previews need OpenCV
+    import cv2
+    colors = map_colors(int(grid_map.max()) + 1, seed)
+    cv2.imwrite(path, render_map(grid_map, colors, pixels_per_cell, grid_lines=pixels_per_cell > 2))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default=250, type=int)
+    parser.add_argument("--cols", default=400, type=int)
+    parser.add_argument("--block_size", default=12, type=int)
+    parser.add_argument("--street_width", default=2, type=int)
+    parser.add_argument("--home_size", default=[3, 5], type=int, nargs=2)
+    parser.add_argument("--home_density", default=0.8, type=float)
+    parser.add_argument("--park_fraction", default=0.1, type=float)
+    parser.add_argument("--num_entrances", default=20, type=int)
+    parser.add_argument("--seed", default=None, type=int)
+    parser.add_argument("--save_path", default="city_map.npy")
+    parser.add_argument("--preview", default=None, help="png with the map")
+    parser.add_argument("--pixels_per_cell", default=2, type=int)
+    parser.add_argument("--config", default=None, help="yml with the environment section for the map")
+    parser.add_argument("--scenario", default="city")
+    parser.add_argument("--num_agents_allowed", default=100, type=int)
+    parser.add_argument("--max_time_outside", default=30, type=int)
+    parser.add_argument("--num_target_cells", default=200, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    grid_map, entrances = generate_map(args.rows, args.cols, args.block_size, args.street_width, args.home_size,
+                                       args.home_density, args.park_fraction, args.num_entrances, args.seed)
+    np.save(args.save_path, grid_map)
+    print(f'{int(grid_map.max()) - InteriorType.HOME.value + 1} homes, '
+          f'{int((grid_map == InteriorType.COMMON_SPACE.value).sum())} common cells, saved to {args.save_path}')
+    if args.preview is not None:
+        save_preview(args.preview, grid_map, args.pixels_per_cell, args.seed)
+    if args.config is not None:
+        environment = {args.scenario: {'map_path': args.save_path,
+                                       'num_agents_allowed': args.num_agents_allowed,
+                                       'max_time_outside': args.max_time_outside,
+                                       'num_target_cells': args.num_target_cells,
+                                       'entrance_cells': entrances}}
+        with open(args.config, 'w') as f:
+            yaml.safe_dump({'environment': environment}, f, default_flow_style=None, sort_keys=False)
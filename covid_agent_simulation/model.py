@@ -1,70 +1,155 @@
+import os
+import random
+from collections import deque
+
 from mesa import Model
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
-from mesa.datacollection import DataCollector
 import numpy as np
 
+from .admission import AdmissionQueue
 from .agents import (CoronavirusAgent, InteriorAgent,
-                     CoronavirusAgentState, InteriorType, WallAgent)
-
-
-class Counter:
-    _count = 0
-
-    @property
-    def count(self):
-        return self._count
-
-    def add(self):
-        self._count += 1
-
-    def subtract(self):
-        if self._count > 0:
-            self._count -= 1
+                     CoronavirusAgentState, InteriorType, WallAgent, EMPTY_CELL, agent_portrayals)
+from .cache import get_cache_dir
+from .datacollection import ColumnarDataCollector
+from .engine import VectorizedEngine
+from .infection import InfectionKernel
+from .instrumentation import PhaseProfiler, NullProfiler
+from .movement import load_movement_tables
+from .scenario import load_scenario
+from .scheduling import EventActivation
+from .transmission import TransmissionLog
 
 
 class CoronavirusModel(Model):
     def __init__(self, num_agents=10,
-                 config=None, scenario='park', going_out_prob_mean=0.05):
+                 config=None, scenario='park', going_out_prob_mean=0.05, with_interiors=True,
+                 engine='mesa', seed=None, replicate=None, output_dir=None, profile=False, replicates=1,
+                 tiles=2, scheduler='random'):
+        """
+        engine: 'mesa' steps one CoronavirusAgent at a time through the schedule,
+        'vectorized' keeps agents as arrays and steps them all at once (headless only),
+        'tiled' splits the map into tiles stepped by as many worker processes (headless only).
+        seed: seed of all the random draws of the model, config['common']['random_seed'] by default.
+        replicate: index of an independent random stream spawned from the seed,
+        so that replicates of one seed don't overlap and each of them can be rerun alone.
+        output_dir: where collected data is streamed to, it is kept in memory if not given.
+        profile: record time spent in every phase of a tick in self.profiler.
+        replicates: number of independent populations stepped at once on the same map
+        (vectorized engine only), state counts and reporters then have one value per replicate.
+        tiles: number of tiles of the tiled engine.
+        scheduler: 'random' steps every agent in every tick, 'event' only the ones that have
+        something to do, see EventActivation (mesa engine only).
+        """
+        if engine not in ('mesa', 'vectorized', 'tiled'):
+            raise ValueError(f'Unknown engine: {engine}')
+        if replicates > 1 and engine != 'vectorized':
+            raise ValueError('Replicates are only supported by the vectorized engine')
+        if scheduler not in ('random', 'event'):
+            raise ValueError(f'Unknown scheduler: {scheduler}')
+        if scheduler == 'event' and engine != 'mesa':
+            raise ValueError('The event scheduler is only supported by the mesa engine')
 
         self.config = config
-        np.random.RandomState(config['common']['random_seed'])
-        grid_map = self.load_gridmap(scenario)
+        self.profiler = PhaseProfiler() if profile else NullProfiler()
+        self.output_dir = output_dir
+        self.replicate = replicate
+        self.setup_random(config['common']['random_seed'] if seed is None else seed,
+                          () if replicate is None else (replicate,))
+        cache_dir = get_cache_dir(config)
+        self.compiled_scenario = load_scenario(self.config['environment'][scenario]['map_path'],
+                                               self.config['environment'][scenario]['entrance_cells'],
+                                               cache_dir)
 
         self.num_agents = num_agents
         self.scenario = scenario
-        self.grid = MultiGrid(grid_map.shape[1], grid_map.shape[0], False)
-        self.schedule = RandomActivation(self)
-        self.datacollector = DataCollector(
+        self.engine_name = engine
+        self.with_interiors = with_interiors
+        self.replicates = replicates
+        self.grid = MultiGrid(*self.compiled_scenario.home_ids.shape, False)
+        self.schedule = EventActivation(self) if scheduler == 'event' else RandomActivation(self)
+        # number of agents in each state, indexed by CoronavirusAgentState value
+        self.state_counts = np.zeros(self.replicates_shape + (len(CoronavirusAgentState) + 1,), dtype=int)
+        collector_config = self.config['common'].get('datacollector', {})
+        self.datacollector = ColumnarDataCollector(
             model_reporters={"Infected": all_infected,
                              "Healthy": all_healthy,
-                             "Recovered": all_recovered}
+                             "Recovered": all_recovered,
+                             "Waiting": waiting_agents,
+                             "Mean wait": mean_wait},
+            chunk_size=collector_config.get('chunk_size', 1000),
+            output_dir=output_dir,
+            file_format=collector_config.get('format', 'npz'),
+            agent_snapshot_every=collector_config.get('agent_snapshot_every'),
+            value_shape=self.replicates_shape
         )
-
-        # select cells that will be used as possible target cells
-        # for agents to head to. They have home_id as InteriorType.COMMON_SPACE.value
-        common_space_cells = np.asarray(list(zip(*np.where(grid_map == InteriorType.COMMON_SPACE.value))))
-        self.available_target_cells =\
-            common_space_cells[np.random.choice(range(len(common_space_cells)),
-                                           size=self.config['environment'][scenario]['num_target_cells'])]
-        self.counter = Counter()
-        self.num_agents_allowed_outside = self.config['environment'][scenario]['num_agents_allowed']
-
+        # who infected whom, see transmission.py
+        self.transmissions = TransmissionLog(output_dir=output_dir, file_format=collector_config.get('format', 'npz')) \
+            if collector_config.get('transmissions') else None
         self.going_out_prob_mean = going_out_prob_mean/10
         self.global_max_index = 0
         self.infection_probabilities = self.config['common']['infection_probabilities']
+        self.agent_portrayals = agent_portrayals(self.config)
 
-        self.setup_interiors(grid_map)
+        self.setup_layers()
+        self.infection_kernel = InfectionKernel(self.home_ids, self.infection_probabilities)
+
+        self.setup_common_area_entrance(self.config['environment'][scenario]['entrance_cells'])
+        self.admission = AdmissionQueue(self.config['environment'][scenario]['num_agents_allowed'],
+                                        len(self.entrance_areas), self.replicates_shape)
+        self.movement = load_movement_tables(self.home_ids,
+                                             [[self.cell_index(pos) for pos in area] for area in self.entrance_areas],
+                                             cache_dir)
+
+        # select cells that will be used as possible target cells
+        # for agents to head to. They have home_id as InteriorType.COMMON_SPACE.value
+        # and agents coming in through the entrances can walk to them
+        common_space_cells = self.movement.reachable_from_entrances()
+        target_cells = common_space_cells[self.rng.choice(len(common_space_cells),
+                                                          size=self.config['environment'][scenario]['num_target_cells'])]
+        self.available_target_cells = np.stack(np.divmod(target_cells, self.grid.height), axis=1)
+        self.movement.set_targets(target_cells)
+
+        # InteriorAgents are only needed to draw the map in the browser
+        if with_interiors:
+            self.setup_interiors(self.load_gridmap(scenario))
 
         # Maybe it will look better with walls
         # if we're going to have irregular shapes, but I don't know...
         #self.setup_walls()
 
-        self.setup_agents()
-        self.setup_common_area_entrance(self.config['environment'][scenario]['entrance_cells'])
-
+        if engine == 'vectorized':
+            self.engine = VectorizedEngine(self)
+        elif engine == 'tiled':
+            # shared memory needs Python 3.8, the other engines don't import it
+            from .tiling import TiledEngine
+            self.engine = TiledEngine(self, tiles)
+        else:
+            self.engine = None
+            self.setup_agents()
+
+        if self.transmissions is not None:
+            self.log_initial_infections()
+
+        # see check_stopping
+        self.stopping = self.config['common'].get('stopping') or {}
+        self.infected_history = deque(maxlen=(self.stopping.get('flat_ticks') or 0) + 1)
+        self.stop_reason = None
         self.running = True
         self.datacollector.collect(self)
+        self.check_stopping()
+
+    @property
+    def replicates_shape(self):
+        return (self.replicates,) if self.replicates > 1 else ()
+
+    @property
+    def num_agents_allowed_outside(self):
+        return self.admission.num_agents_allowed
+
+    @num_agents_allowed_outside.setter
+    def num_agents_allowed_outside(self, value):
+        self.admission.num_agents_allowed = value
 
     def load_gridmap(self, scenario):
         path = self.config['environment'][scenario]['map_path']
@@ -72,9 +157,23 @@ class CoronavirusModel(Model):
 
         return grid_map
 
-    @staticmethod
-    def clipped_normal_dist_prob(mu):
-        prob = np.random.normal(mu, mu/2)
+    def setup_random(self, seed, spawn_key=()):
+        """
+        Everything random in the model, its agents and its engine draws from
+        self.rng or self.random (used by mesa's schedule), both derived from
+        one seed sequence owned by the model.
+        """
+        self.seed = seed
+        # (replicate,) is the same stream as np.random.SeedSequence(seed).spawn(replicate + 1)[replicate]
+        self.spawn_key = tuple(spawn_key)
+        seed_sequence = np.random.SeedSequence(seed, spawn_key=spawn_key)
+        self.rng = np.random.default_rng(seed_sequence)
+        self.random = random.Random(int(seed_sequence.generate_state(1)[0]))
+        # sources of infections are drawn from their own stream, so logging them doesn't change the run
+        self.transmission_rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+
+    def clipped_normal_dist_prob(self, mu):
+        prob = self.rng.normal(mu, mu/2)
         prob = np.clip(prob, 0, 1)
         return prob
 
@@ -106,29 +205,32 @@ class CoronavirusModel(Model):
 
         # Vertical lines look strange...
 
+    def setup_layers(self):
+        """
+        Keeps the map as arrays indexed like the grid, i.e. [x, y],
+        so that cell lookups don't need to scan the agents in a cell.
+        """
+        # read-only views on the compiled scenario
+        self.home_ids = self.compiled_scenario.home_ids
+        self.cell_types = self.compiled_scenario.cell_types
+        # unique_id of the CoronavirusAgent standing in a cell or EMPTY_CELL
+        # with many replicates every one of them has its own layer
+        self.occupancy = np.full(self.replicates_shape + self.home_ids.shape, EMPTY_CELL, dtype=int)
+
     def setup_agents(self):
-        home_coors = []
-        for info in self.grid.coord_iter():
-            contents = info[0]
-            coors = info[1:]
-            for object in contents:
-                try:
-                    if object.interior_type == InteriorType.HOME:
-                        home_coors.append(coors)
-                except AttributeError:
-                    pass
-
-        if self.num_agents > len(home_coors):
-            self.num_agents = len(home_coors)
+        home_cells = self.compiled_scenario.home_cells
+
+        if self.num_agents > len(home_cells):
+            self.num_agents = len(home_cells)
             print(f'Too many agents, they cannot fit into homes. Creating just: {self.num_agents}')
 
-        nb_infected, nb_recovered = 0, 0
-        for i in range(self.num_agents):
-            ind = np.random.randint(0, len(home_coors), 1)[0]
-            x, y = home_coors[ind]
-            del home_coors[ind]  # make sure agents are not placed in the same cell
+        # make sure agents are not placed in the same cell
+        home_cells = self.rng.choice(home_cells, size=self.num_agents, replace=False)
 
-            home_id = [a.home_id for a in self.grid.get_cell_list_contents((x, y)) if type(a) == InteriorAgent]
+        nb_infected, nb_recovered = 0, 0
+        for cell in home_cells:
+            x, y = self.cell_pos(cell)
+            home_id = self.get_cell_id((x, y))
             state = CoronavirusAgentState.HEALTHY
             # if np.random.rand() < self.config['common']['initially_infected_population']:
             # number of initially infected should not be random but a percentage
@@ -139,12 +241,10 @@ class CoronavirusModel(Model):
                 state = CoronavirusAgentState.RECOVERED
                 nb_recovered += 1
             a = CoronavirusAgent(self.get_unique_id(), self, state, home_id=home_id,
-                                 config=self.config,
                                  max_being_out_steps=self.config['environment'][self.scenario]['max_time_outside'],
-                                 going_out_prob=self.clipped_normal_dist_prob(self.going_out_prob_mean),
-                                 outside_agents_counter=self.counter)
+                                 going_out_prob=self.clipped_normal_dist_prob(self.going_out_prob_mean))
             self.schedule.add(a)
-            self.grid.place_agent(a, (x, y))
+            self.place_agent(a, (x, y))
             a.set_home_address((x, y))
 
     def setup_interior(self, row, column, agent_id, interior_type, home_id=None, color="AliceBlue", shape=None):
@@ -167,38 +267,207 @@ class CoronavirusModel(Model):
     def setup_common_area_entrance(self, entrances):
         entrances_flip_row = [[self.grid.height - e[0] - 1, e[1]] for e in entrances]
         self.common_area_entrances = entrances_flip_row
+        # cells agents going out are teleported to, for each entrance
+        self.entrance_areas = self.compiled_scenario.entrance_areas()
 
     def get_cell_id(self, pos):
-        agents_in_cell = self.grid.get_cell_list_contents(pos)
-        for a in agents_in_cell:
-            if type(a) == InteriorAgent:
-                return a.home_id
-        raise RuntimeError('Cell without inferior agent found')
+        return self.home_ids[pos]
 
-    def step(self):
-        self.schedule.step()
-        self.datacollector.collect(self)
+    def get_cell_type(self, pos):
+        return InteriorType(self.cell_types[pos])
+
+    def cell_index(self, pos):
+        return pos[0] * self.grid.height + pos[1]
+
+    def cell_pos(self, cell):
+        return tuple(divmod(int(cell), self.grid.height))
+
+    def is_cell_taken(self, cells):
+        """cells: flat cell indices"""
+        return self.occupancy.ravel()[cells] != EMPTY_CELL
 
-    def run_model(self, n):
+    def count_neighbors_of_cells(self, cells):
+        """Number of agents in the Moore neighbourhood of each of the cells (flat indices)."""
+        neighbors = self.movement.neighbors[cells]
+        self.profiler.count('neighbor_queries', len(cells))
+        occupied = self.occupancy.ravel()[np.maximum(neighbors, 0)] != EMPTY_CELL
+        return np.count_nonzero(occupied & (neighbors != EMPTY_CELL), axis=1)
+
+    def place_agent(self, agent, pos):
+        self.grid.place_agent(agent, pos)
+        self.occupancy[pos] = agent.unique_id
+
+    def move_agent(self, agent, pos):
+        old_pos = agent.pos
+        self.grid.move_agent(agent, pos)
+        # agents teleported to an entrance may share a cell for a while
+        left_behind = [a for a in self.grid.get_cell_list_contents([old_pos]) if type(a) == CoronavirusAgent]
+        self.occupancy[old_pos] = left_behind[0].unique_id if left_behind else EMPTY_CELL
+        self.occupancy[pos] = agent.unique_id
+
+    def step(self):
+        with self.profiler.phase('step'):
+            if self.engine is not None:
+                self.engine.step()
+            else:
+                self.schedule.step()
+                with self.profiler.phase('go_out'):
+                    self.admit_agents()
+                with self.profiler.phase('infection'):
+                    self.spread_infection()
+            with self.profiler.phase('collect'):
+                self.datacollector.collect(self)
+            self.check_stopping()
+        self.profiler.end_tick()
+
+    def check_stopping(self):
+        """
+        Stops the model when nothing can change anymore, by the criteria in config['common']['stopping']:
+        no_infected: there are no infected agents left.
+        flat_ticks, flat_tolerance: the number of infected agents stayed within flat_tolerance
+        for flat_ticks ticks.
+        replicates_fraction: with many replicates, the fraction of them meeting one of the criteria.
+        infected_upper_bound, confidence_z: with many replicates, the upper confidence bound of the
+        mean percentage of infected agents over replicates, mean + confidence_z standard errors,
+        is at most infected_upper_bound, i.e. the epidemic is over in the ensemble with that confidence.
+        The criterion met is kept in self.stop_reason.
+        """
+        infected = np.atleast_1d(self.state_counts[..., CoronavirusAgentState.INFECTED.value])
+        self.infected_history.append(infected.copy())
+        reasons = np.full(len(infected), None)
+        if self.stopping.get('flat_ticks') and len(self.infected_history) == self.infected_history.maxlen:
+            history = np.array(self.infected_history)
+            flat = history.max(axis=0) - history.min(axis=0) <= self.stopping.get('flat_tolerance', 0)
+            reasons[flat] = 'steady_state'
+        if self.stopping.get('no_infected'):
+            reasons[infected == 0] = 'no_infected'
+
+        settled = np.array([reason is not None for reason in reasons])
+        if len(reasons) == 1 and settled[0]:
+            self.stop_reason = reasons[0]
+        elif len(reasons) > 1 and settled.mean() >= self.stopping.get('replicates_fraction', 1.0):
+            self.stop_reason = 'replicates_settled'
+        elif len(reasons) > 1 and self.stopping.get('infected_upper_bound') is not None:
+            percent = infected / self.num_agents * 100
+            standard_error = percent.std(ddof=1) / np.sqrt(len(percent))
+            upper = percent.mean() + self.stopping.get('confidence_z', 1.96) * standard_error
+            if upper <= self.stopping['infected_upper_bound']:
+                self.stop_reason = 'confidence_bound'
+        self.running = self.stop_reason is None
+
+    def admit_agents(self):
+        """Agents of the admission queue go out, once everybody else moved."""
+        for a in self.admission.admit():
+            a.go_out()
+            if isinstance(self.schedule, EventActivation):
+                self.schedule.add_outside(a)
+        self.admission.next_tick()
+
+    def spread_infection(self):
+        agents = self.schedule.agents
+        sources = np.zeros(self.home_ids.shape)
+        infected = [a for a in agents if a.state == CoronavirusAgentState.INFECTED]
+        for a in infected:
+            sources[a.pos] += 1
+        pressure = self.infection_kernel.pressure(sources)
+        targets = []
+        for a in agents:
+            if a.state == CoronavirusAgentState.HEALTHY and self.rng.random() < pressure[a.pos]:
+                a.state = CoronavirusAgentState.INFECTED
+                targets.append(a)
+                if isinstance(self.schedule, EventActivation):
+                    self.schedule.add_infected(a)
+        if self.transmissions is not None and targets:
+            self.log_transmissions(np.array([self.cell_index(a.pos) for a in infected]),
+                                   np.array([a.unique_id for a in infected]),
+                                   np.array([self.cell_index(a.pos) for a in targets]),
+                                   np.array([a.unique_id for a in targets]))
+
+    def log_transmissions(self, source_cells, source_ids, target_cells, target_ids, replicates=0):
+        """Cells are flat, offset by the replicate with many replicates, see InfectionKernel.attribute."""
+        sources, distance = self.infection_kernel.attribute(source_cells, target_cells, self.transmission_rng)
+        self.record_transmissions(source_ids[sources], target_ids, target_cells % self.home_ids.size, distance,
+                                  replicates)
+
+    def record_transmissions(self, sources, targets, cells, distance, replicates=0):
+        """Infections of this tick with known sources, cells are flat cells of the map."""
+        self.transmissions.append(self.datacollector.steps_collected, sources, targets, cells, distance,
+                                  self.cell_types.ravel()[cells] == InteriorType.HOME.value, replicates)
+
+    def log_initial_infections(self):
+        snapshot = self.agent_snapshot()
+        infected = snapshot['state'] == CoronavirusAgentState.INFECTED.value
+        cells = snapshot['x'][infected] * self.grid.height + snapshot['y'][infected]
+        self.record_transmissions(EMPTY_CELL, snapshot['unique_id'][infected], cells, 0,
+                                  snapshot['replicate'][infected] if 'replicate' in snapshot else 0)
+
+    def close(self):
+        """Stops the worker processes of the tiled engine and frees its shared memory."""
+        if self.engine is not None:
+            self.engine.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run_model(self, n, trace_path=None):
+        """
+        Runs n steps or until the model stops running, see check_stopping.
+        trace_path: when profiling, where to save the Chrome trace of the run.
+        Returns the profiler summary when profiling, also saved to <output_dir>/profile.txt,
+        None otherwise.
+        """
         for i in range(n):
+            if not self.running:
+                break
             self.step()
+        self.datacollector.flush()
+        if self.transmissions is not None:
+            self.transmissions.flush()
+        if not self.profiler.enabled:
+            return None
+        if trace_path is not None:
+            self.profiler.dump_chrome_trace(trace_path)
+        summary = self.profiler.summary()
+        if self.output_dir is not None:
+            with open(os.path.join(self.output_dir, 'profile.txt'), 'w') as f:
+                f.write(summary.to_string() + '\n')
+        return summary
+
+    def agent_snapshot(self):
+        if self.engine is not None:
+            return self.engine.agent_snapshot()
+        agents = self.schedule.agents
+        return {'unique_id': np.array([a.unique_id for a in agents]),
+                'x': np.array([a.pos[0] for a in agents]),
+                'y': np.array([a.pos[1] for a in agents]),
+                'state': np.array([a._state for a in agents], dtype=np.int8)}
 
 
 def all_infected(model):
     return get_all_in_state(model, CoronavirusAgentState.INFECTED)\
-           / len(model.schedule.agents) * 100
+           / model.num_agents * 100
 
 
 def all_healthy(model):
     return get_all_in_state(model, CoronavirusAgentState.HEALTHY)\
-           / len(model.schedule.agents) * 100
+           / model.num_agents * 100
 
 
 def all_recovered(model):
     return get_all_in_state(model, CoronavirusAgentState.RECOVERED)\
-          / len(model.schedule.agents) * 100
+          / model.num_agents * 100
+
+
+def waiting_agents(model):
+    return model.admission.queue_length
+
+
+def mean_wait(model):
+    return model.admission.mean_wait
 
 
 def get_all_in_state(model, state):
-    return len([1 for agent in model.schedule.agents
-                if type(agent) == CoronavirusAgent and agent.state == state])
+    return model.state_counts[..., state.value]
@@ -0,0 +1,150 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
+
+from .agents import InteriorType, EMPTY_CELL
+from .cache import array_digest, save_npz
+
+# Moore neighbourhood of a cell, without the cell itself
+MOORE_OFFSETS = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy])
+# distance of cells that can't be reached by walking
+UNREACHABLE_DISTANCE = -1
+
+
+class DistanceCache:
+    """
+    Distances from single cells, by the walkable graph and the cell, kept in memory
+    by the process, e.g. a worker of a sweep, and shared by all its models. The
+    least recently used rows are dropped once they take more than max_bytes.
+    Target cells are drawn anew for every seed, so their tables are never written to disk.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.rows = OrderedDict()
+        self.total_bytes = 0
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is not None:
+            self.rows.move_to_end(key)
+        return row
+
+    def put(self, key, row):
+        self.total_bytes -= self.rows.pop(key).nbytes if key in self.rows else 0
+        self.rows[key] = row
+        self.total_bytes += row.nbytes
+        while len(self.rows) > 1 and self.total_bytes > self.max_bytes:
+            self.total_bytes -= self.rows.popitem(last=False)[1].nbytes
+
+
+TARGET_DISTANCES = DistanceCache(max_bytes=256 * 2 ** 20)
+
+
+class MovementTables:
+    """
+    Everything agents need to know about the static map to move, for cells
+    addressed by flat indices, i.e. x * grid height + y.
+
+    neighbors: (cells, 8) Moore neighbours of every cell, EMPTY_CELL outside of the grid.
+    walkable: (cells, 8) whether an agent can step to the neighbour, i.e. it has
+    the same id as the cell (the common space or the same home).
+    indptr, indices: walkable neighbours in CSR form, the ones of cell c are
+    indices[indptr[c]:indptr[c + 1]].
+    entrance_distance: (entrances, cells) number of steps from every entrance area to every cell.
+    target_distance: (targets, cells) number of steps from every target cell to every cell,
+    set with set_targets, int16 unless the map has longer walks.
+    Distances are shortest walks through walkable cells, UNREACHABLE_DISTANCE if there is none.
+    """
+    def __init__(self, neighbors, walkable, indptr, indices, entrance_distance, target_distance=None):
+        self.neighbors = neighbors
+        self.walkable = walkable
+        self.indptr = indptr
+        self.indices = indices
+        self.entrance_distance = entrance_distance
+        self.target_distance = target_distance
+
+    def walkable_neighbors(self, cell):
+        return self.indices[self.indptr[cell]:self.indptr[cell + 1]]
+
+    def reachable_from_entrances(self):
+        return np.flatnonzero((self.entrance_distance != UNREACHABLE_DISTANCE).any(axis=0))
+
+    def distance_field(self, sources):
+        """
+        Breadth-first search from the source cells over walkable cells,
+        one row of distances per source.
+        """
+        cells = len(self.indptr) - 1
+        graph = csr_matrix((np.ones(len(self.indices)), self.indices, self.indptr), shape=(cells, cells))
+        distance = shortest_path(graph, unweighted=True, indices=np.asarray(sources, dtype=int))
+        return np.where(np.isinf(distance), UNREACHABLE_DISTANCE, distance).astype(np.int32)
+
+    def set_targets(self, target_cells):
+        """target_cells: flat indices, rows of the cells already in TARGET_DISTANCES are reused."""
+        if len(target_cells) == 0:
+            self.target_distance = np.empty((0, len(self.indptr) - 1), dtype=np.int16)
+            return
+        graph = array_digest(self.indptr, self.indices)
+        rows = {int(cell): TARGET_DISTANCES.get((graph, int(cell))) for cell in target_cells}
+        missing = [cell for cell, row in rows.items() if row is None]
+        if missing:
+            for cell, row in zip(missing, compact(self.distance_field(missing))):
+                rows[cell] = row
+                TARGET_DISTANCES.put((graph, cell), row)
+        self.target_distance = np.stack([rows[int(cell)] for cell in target_cells])
+
+    def arrays(self):
+        return {'neighbors': self.neighbors, 'walkable': self.walkable, 'indptr': self.indptr,
+                'indices': self.indices, 'entrance_distance': self.entrance_distance}
+
+
+def compact(distance):
+    """Distances as int16 when they fit, they take half the memory of int32."""
+    if distance.size and distance.max() >= np.iinfo(np.int16).max:
+        return distance
+    return distance.astype(np.int16)
+
+
+def compute_movement_tables(home_ids, entrance_areas):
+    """entrance_areas: list of flat indices of the cells of every entrance"""
+    width, height = home_ids.shape
+    x, y = np.divmod(np.arange(width * height), height)
+    nx = x[:, None] + MOORE_OFFSETS[:, 0]
+    ny = y[:, None] + MOORE_OFFSETS[:, 1]
+    inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+    neighbors = np.where(inside, nx * height + ny, EMPTY_CELL)
+
+    cell_ids = home_ids.ravel()
+    walkable = inside & (cell_ids[np.maximum(neighbors, 0)] == cell_ids[:, None]) & \
+        (cell_ids[:, None] != InteriorType.UNREACHABLE.value)
+    indptr = np.concatenate([[0], np.cumsum(np.count_nonzero(walkable, axis=1))])
+    indices = neighbors[walkable]
+
+    tables = MovementTables(neighbors, walkable, indptr, indices,
+                            np.empty((len(entrance_areas), width * height), dtype=np.int32))
+    for i, area in enumerate(entrance_areas):
+        distance = tables.distance_field(area)
+        # the walk starts from the closest cell of the area
+        distance = np.where(distance == UNREACHABLE_DISTANCE, np.iinfo(np.int32).max, distance).min(axis=0)
+        tables.entrance_distance[i] = np.where(distance == np.iinfo(np.int32).max, UNREACHABLE_DISTANCE, distance)
+    return tables
+
+
+def load_movement_tables(home_ids, entrance_areas, cache_dir):
+    """Tables of the map and its entrances, computed once and then read from the cache."""
+    key = array_digest(home_ids, *[np.asarray(area) for area in entrance_areas])
+    arrays = cached(os.path.join(cache_dir, f'movement_{key}.npz'),
+                    lambda: compute_movement_tables(home_ids, entrance_areas).arrays())
+    return MovementTables(**arrays)
+
+
+def cached(path, compute):
+    if os.path.exists(path):
+        with np.load(path) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+    arrays = compute()
+    save_npz(path, **arrays)
+    return arrays
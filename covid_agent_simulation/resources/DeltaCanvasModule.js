@@ -0,0 +1,104 @@
+/**
+ * Counterpart of DeltaCanvasGrid in visualization.py.
+ *
+ * The map is drawn once on its own canvas, agents on another one on top of it.
+ * Every frame only redraws the cells listed in data.cells, pairs of
+ * (cell, state) where cell = x * grid_height + y and state -1 is an empty cell.
+ */
+var DeltaCanvasModule = function(canvas_width, canvas_height, grid_width, grid_height, map_colors, agent_styles) {
+	var canvas_tag = `<canvas width="${canvas_width}" height="${canvas_height}" class="world-grid"/>`;
+	var parent = $('<div style="height:' + canvas_height + 'px;" class="world-grid-parent"></div>')[0];
+	var map_canvas = $(canvas_tag)[0];
+	var agent_canvas = $(canvas_tag)[0];
+	$("#elements").append(parent);
+	parent.append(map_canvas);
+	parent.append(agent_canvas);
+
+	var map_context = map_canvas.getContext("2d");
+	var agent_context = agent_canvas.getContext("2d");
+	var cell_width = Math.floor(canvas_width / grid_width);
+	var cell_height = Math.floor(canvas_height / grid_height);
+
+	// agents drawn with images are loaded once, the other ones are circles of their color
+	var images = agent_styles.map(function(style) {
+		if (style === null || style.shape.indexOf(".") === -1)
+			return null;
+		var img = new Image();
+		img.src = "local/" + style.shape;
+		return img;
+	});
+	// the last state of every cell, to redraw it when its image has loaded
+	var cells = new Int32Array(grid_width * grid_height).fill(-1);
+	images.forEach(function(img, state) {
+		if (img !== null)
+			img.onload = function() {
+				for (var cell = 0; cell < cells.length; cell++)
+					if (cells[cell] === state)
+						drawCell(cell, state);
+			};
+	});
+
+	var decode = function(text, ArrayType) {
+		var binary = atob(text);
+		var bytes = new Uint8Array(binary.length);
+		for (var i = 0; i < binary.length; i++)
+			bytes[i] = binary.charCodeAt(i);
+		return new ArrayType(bytes.buffer);
+	};
+
+	// canvas y goes down, grid y goes up
+	var cellX = function(cell) { return Math.floor(cell / grid_height) * cell_width; };
+	var cellY = function(cell) { return (grid_height - cell % grid_height - 1) * cell_height; };
+
+	var drawMap = function(types) {
+		for (var cell = 0; cell < types.length; cell++) {
+			map_context.fillStyle = map_colors[types[cell]];
+			map_context.fillRect(cellX(cell), cellY(cell), cell_width, cell_height);
+		}
+		map_context.strokeStyle = "#eee";
+		map_context.beginPath();
+		for (var x = 0; x <= grid_width; x++) {
+			map_context.moveTo(x * cell_width, 0);
+			map_context.lineTo(x * cell_width, grid_height * cell_height);
+		}
+		for (var y = 0; y <= grid_height; y++) {
+			map_context.moveTo(0, y * cell_height);
+			map_context.lineTo(grid_width * cell_width, y * cell_height);
+		}
+		map_context.stroke();
+	};
+
+	var drawCell = function(cell, state) {
+		var x = cellX(cell), y = cellY(cell);
+		agent_context.clearRect(x, y, cell_width, cell_height);
+		if (state === -1)
+			return;
+		var img = images[state];
+		if (img !== null) {
+			if (img.complete)
+				agent_context.drawImage(img, x, y, cell_width, cell_height);
+		} else {
+			agent_context.fillStyle = agent_styles[state].color;
+			agent_context.beginPath();
+			agent_context.arc(x + cell_width / 2, y + cell_height / 2, Math.min(cell_width, cell_height) / 4, 0, 2 * Math.PI);
+			agent_context.fill();
+		}
+	};
+
+	this.render = function(data) {
+		if (data.map !== undefined) {
+			this.reset();
+			drawMap(decode(data.map, Int8Array));
+		}
+		var changes = decode(data.cells, Int32Array);
+		for (var i = 0; i < changes.length; i += 2) {
+			cells[changes[i]] = changes[i + 1];
+			drawCell(changes[i], changes[i + 1]);
+		}
+	};
+
+	this.reset = function() {
+		agent_context.clearRect(0, 0, canvas_width, canvas_height);
+		cells.fill(-1);
+	};
+};
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .agents import InteriorType
+from .cache import array_digest, file_digest
+
+# part of the cache path of compiled scenarios, bump it whenever compile_scenario gives other arrays
+SCENARIO_FORMAT = 2
+
+
+class CompiledScenario:
+    """
+    Everything a model needs from a map and its entrances, as arrays in grid
+    coordinates. Cells are flat indices, i.e. x * grid height + y.
+
+    home_ids, cell_types: (width, height) map layers.
+    home_cells, common_cells: cells of all homes and of the common space.
+    entrance_cells, entrance_indptr: walkable cells of every entrance area in CSR form,
+    the ones of entrance i are entrance_cells[entrance_indptr[i]:entrance_indptr[i + 1]].
+    home_group_ids, home_group_indptr, home_group_cells: cells of every home in CSR form.
+    """
+    FIELDS = ['home_ids', 'cell_types', 'home_cells', 'common_cells', 'entrance_cells', 'entrance_indptr',
+              'home_group_ids', 'home_group_indptr', 'home_group_cells']
+
+    def __init__(self, **arrays):
+        for name in self.FIELDS:
+            setattr(self, name, arrays[name])
+        self.height = self.home_ids.shape[1]
+
+    def entrance_areas(self):
+        """Positions of the cells of every entrance area."""
+        return [[tuple(divmod(int(cell), self.height)) for cell in
+                 self.entrance_cells[self.entrance_indptr[i]:self.entrance_indptr[i + 1]]]
+                for i in range(len(self.entrance_indptr) - 1)]
+
+    def cells_of_home(self, home_id):
+        i = np.searchsorted(self.home_group_ids, home_id)
+        return self.home_group_cells[self.home_group_indptr[i]:self.home_group_indptr[i + 1]]
+
+
+def compile_scenario(grid_map, entrances):
+    """
+    grid_map: map as drawn with draw_map.py, rows from the top.
+    entrances: entrance cells from the config, [row, column] of the map.
+    """
+    # origin of grid here is at left bottom, not like in opencv left top, so we need to flip y axis
+    home_ids = np.flipud(grid_map).T.astype(int)
+    cell_types = np.minimum(home_ids, InteriorType.HOME.value)
+    width, height = home_ids.shape
+    cell_ids = home_ids.ravel()
+
+    # agents going out are teleported to the entrance cell or the one above it
+    entrance_cells, entrance_indptr = [], [0]
+    for i, (map_row, column) in enumerate(entrances):
+        row = height - map_row - 1
+        area = [column * height + y for y in [row, row + 1]
+                if y < height and cell_ids[column * height + y] == InteriorType.COMMON_SPACE.value]
+        # dropping the entrance would shift the index of every later one, agents and
+        # the admission queue count agents outside by the index of their entrance
+        if not area:
+            raise ValueError(f'Entrance {i} at [{map_row}, {column}] has no common space cell')
+        entrance_cells += area
+        entrance_indptr.append(len(entrance_cells))
+
+    home_cells = np.flatnonzero(cell_types.ravel() == InteriorType.HOME.value)
+    # stable sort keeps the cells of every home in order
+    grouped = home_cells[np.argsort(cell_ids[home_cells], kind='stable')]
+    home_group_ids, counts = np.unique(cell_ids[grouped], return_counts=True)
+
+    return {'home_ids': home_ids,
+            'cell_types': cell_types,
+            'home_cells': home_cells,
+            'common_cells': np.flatnonzero(cell_types.ravel() == InteriorType.COMMON_SPACE.value),
+            'entrance_cells': np.array(entrance_cells, dtype=int),
+            'entrance_indptr': np.array(entrance_indptr, dtype=int),
+            'home_group_ids': home_group_ids,
+            'home_group_indptr': np.concatenate([[0], np.cumsum(counts)]),
+            'home_group_cells': grouped}
+
+
+def load_scenario(map_path, entrances, cache_dir):
+    """
+    Compiles the map once into a directory of .npy files in the cache,
+    later models memory-map them, so all models of a process share the pages.
+    """
+    entrances_digest = array_digest(np.asarray(entrances, dtype=int).reshape(-1, 2))
+    path = os.path.join(cache_dir,
+                        f'scenario_v{SCENARIO_FORMAT}_{file_digest(map_path)[:20]}_{entrances_digest[:20]}')
+    if not os.path.exists(path):
+        arrays = compile_scenario(np.load(map_path), entrances)
+        # build in a temporary directory so that workers sharing the cache never see half of it
+        tmp_path = tempfile.mkdtemp(dir=cache_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another worker was faster
+            shutil.rmtree(tmp_path)
+
+    return CompiledScenario(**{name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                               for name in CompiledScenario.FIELDS})
@@ -0,0 +1,96 @@
+import heapq
+from collections import defaultdict
+
+from mesa.time import RandomActivation
+
+from .agents import CoronavirusAgentState
+
+
+class EventActivation(RandomActivation):
+    """
+    Activates only the CoronavirusAgents that have something to do in a tick.
+
+    Instead of rolling going_out_prob every tick, an agent at home draws the
+    tick of its next attempt to go out from a geometric distribution, which
+    gives the same odds. The attempt puts it in the admission queue of the
+    model, and it is drawn again once the agent comes back home. Agents at
+    home are stepped when their attempt is due, or when infected and healthy agents are at the same home, where
+    their positions matter for the infection. Agents outside are always stepped.
+    Recoveries don't need the agents to be stepped either, they are popped
+    from a heap keyed on the tick the agent reaches max_infection_steps.
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        # (tick, unique_id) heaps
+        self.go_out_queue = []
+        self.recovery_queue = []
+        self.households = defaultdict(set)
+        self.outside = set()
+        self.infected = set()
+
+    def add(self, agent):
+        super().add(agent)
+        self.households[agent.home_id].add(agent.unique_id)
+        # agents are added at home, before being placed on the grid
+        self.schedule_going_out(agent, self.steps)
+        if agent.state == CoronavirusAgentState.INFECTED:
+            self.add_infected(agent)
+
+    def remove(self, agent):
+        super().remove(agent)
+        self.households[agent.home_id].discard(agent.unique_id)
+        self.outside.discard(agent.unique_id)
+        self.infected.discard(agent.unique_id)
+
+    def schedule_going_out(self, agent, first_tick):
+        if agent.going_out_prob > 0:
+            tick = first_tick + self.model.rng.geometric(agent.going_out_prob) - 1
+            heapq.heappush(self.go_out_queue, (tick, agent.unique_id))
+
+    def add_outside(self, agent):
+        """Called for every agent admitted to go out by the model."""
+        self.outside.add(agent.unique_id)
+
+    def add_infected(self, agent):
+        """Called for every agent that got infected, agent.infected_steps ticks ago."""
+        self.infected.add(agent.unique_id)
+        tick = self.steps + agent.max_infection_steps - agent.infected_steps
+        heapq.heappush(self.recovery_queue, (tick, agent.unique_id))
+
+    def active_households(self):
+        """Members of homes with infected and healthy agents at home."""
+        homes = {self._agents[i].home_id for i in self.infected if i not in self.outside}
+        members = set()
+        for home in homes:
+            at_home = [i for i in self.households[home] if i not in self.outside]
+            if any(self._agents[i].state == CoronavirusAgentState.HEALTHY for i in at_home):
+                members.update(at_home)
+        return members
+
+    def step(self):
+        due = set()
+        while self.go_out_queue and self.go_out_queue[0][0] <= self.steps:
+            due.add(heapq.heappop(self.go_out_queue)[1])
+        moving_at_home = self.active_households()
+
+        active = sorted(self.outside | due | moving_at_home)
+        self.model.profiler.count('active_agents', len(active))
+        self.model.random.shuffle(active)
+        for unique_id in active:
+            agent = self._agents[unique_id]
+            if unique_id in self.outside:
+                if agent.step_outside():
+                    self.outside.discard(unique_id)
+                    self.schedule_going_out(agent, self.steps + 1)
+            else:
+                agent.step_at_home(unique_id in due, move=unique_id in moving_at_home)
+
+        while self.recovery_queue and self.recovery_queue[0][0] <= self.steps:
+            unique_id = heapq.heappop(self.recovery_queue)[1]
+            agent = self._agents[unique_id]
+            agent.infected_steps = agent.max_infection_steps
+            agent.state = CoronavirusAgentState.RECOVERED
+            self.infected.discard(unique_id)
+
+        self.steps += 1
+        self.time += 1
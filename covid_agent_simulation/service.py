@@ -0,0 +1,290 @@
+"""
+Serves runs of the model over HTTP, from a cache whenever possible, e.g. to dashboards.
+
+    python -m covid_agent_simulation.service --port 8600 --workers 4 --max_cache_mb 512
+
+POST /run with a json object
+    {"scenario": "store", "num_agents": 50, "going_out_prob_mean": 0.5, "seed": 1, "steps": 200}
+answers with the summary of the run, like batch.py, and its curves under "series".
+Missing fields get the values of DEFAULT_REQUEST, "config" picks another config of
+the configs directory by name, e.g. "simple_shapes". --max_agents and --max_steps cap
+the size of a run.
+Results are cached on disk under a digest of the request, the config and the map,
+the least recently used ones are deleted when the cache outgrows --max_cache_mb.
+Identical requests arriving while their run is in progress wait for that run.
+Runs go to a pool of worker processes started with the service, which stay up
+between requests with everything a run needs already imported. A worker dying
+fails the runs in progress and the pool is started again for the next requests.
+GET /results/<key> gives a cached result again and GET /stats counts the requests
+by how they were served. --unix_socket serves on a unix socket instead of a port.
+"""
+import argparse
+import asyncio
+import functools
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import tornado.escape
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+from .batch import run_replicate
+from .cache import ResultCache, file_digest, get_cache_dir, json_digest
+from .utils import CONFIG_DIR, get_config
+
+DEFAULT_REQUEST = {'scenario': 'store', 'num_agents': 10, 'going_out_prob_mean': 0.5, 'seed': None,
+                   'replicate': None, 'steps': 200, 'engine': 'vectorized'}
+ENGINES = ['mesa', 'vectorized']
+# the model divides it by 10 to get the mean probability of going out
+GOING_OUT_PROB_MEAN_RANGE = (0, 10)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_request(body, config, max_agents=10000, max_steps=5000):
+    """
+    Request with the defaults filled in and every value of the type the model expects,
+    raises ValueError for requests the model can't run or that are larger than the limits.
+    """
+    if not isinstance(body, dict):
+        raise ValueError('A request is a json object')
+    unknown = set(body) - set(DEFAULT_REQUEST) - {'config'}
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    request = dict(DEFAULT_REQUEST, **{name: value for name, value in body.items() if name != 'config'})
+    if request['seed'] is None:
+        request['seed'] = config['common']['random_seed']
+    if request['scenario'] not in config['environment']:
+        raise ValueError(f'Unknown scenario: {request["scenario"]}')
+    if request['engine'] not in ENGINES:
+        raise ValueError(f'Unknown engine: {request["engine"]}')
+    try:
+        # "0.5" and 0.5 are the same request
+        for name, kind in [('num_agents', int), ('going_out_prob_mean', float), ('seed', int), ('steps', int)]:
+            request[name] = kind(request[name])
+        if request['replicate'] is not None:
+            request['replicate'] = int(request['replicate'])
+    except (TypeError, ValueError) as err:
+        raise ValueError(f'Invalid request: {err}') from err
+    if not 1 <= request['num_agents'] <= max_agents:
+        raise ValueError(f'num_agents must be between 1 and {max_agents}')
+    if not 1 <= request['steps'] <= max_steps:
+        raise ValueError(f'steps must be between 1 and {max_steps}')
+    low, high = GOING_OUT_PROB_MEAN_RANGE
+    if not low <= request['going_out_prob_mean'] <= high:
+        raise ValueError(f'going_out_prob_mean must be between {low} and {high}')
+    if request['seed'] < 0 or (request['replicate'] is not None and request['replicate'] < 0):
+        raise ValueError('seed and replicate must not be negative')
+    return request
+
+
+def config_names(config_path=None):
+    """Configs requests can pick, by name: the ones of the configs directory and the one of the service."""
+    paths = {os.path.splitext(os.path.basename(path))[0]: path
+             for path in glob.glob(os.path.join(CONFIG_DIR, '*.yml'))}
+    paths[None] = config_path
+    return paths
+
+
+@functools.lru_cache(maxsize=None)
+def map_digest(path, mtime):
+    return file_digest(path)
+
+
+def request_key(config, request):
+    map_path = config['environment'][request['scenario']]['map_path']
+    return json_digest({'config': config, 'map': map_digest(map_path, os.path.getmtime(map_path)),
+                        'request': request})
+
+
+def warm_up():
+    """Imports what a run needs, so that the first request to a worker doesn't wait for it."""
+    # datacollection imports pandas only when the curves are read
+    import pandas  # noqa: F401
+    return os.getpid()
+
+
+def run_job(config, request):
+    run = {name: request[name] for name in ['scenario', 'num_agents', 'going_out_prob_mean', 'seed', 'replicate']}
+    return run_replicate(config, dict(run, run_id=None), request['steps'], request['engine'], with_series=True)
+
+
+class JobService:
+    """
+    Answers requests from the cache or by a run in the pool, one run per key at a time.
+    Lives in the event loop of the server, nothing here is thread safe.
+    """
+    def __init__(self, config_path=None, cache_dir=None, max_cache_bytes=None, workers=None,
+                 max_agents=10000, max_steps=5000):
+        # requests can only name configs known at startup, never paths
+        self.configs = config_names(config_path)
+        self.max_agents = max_agents
+        self.max_steps = max_steps
+        self.cache = ResultCache(cache_dir or os.path.join(get_cache_dir(get_config(config_path)), 'results'),
+                                 max_bytes=max_cache_bytes)
+        self.workers = workers or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        # key -> future of its run
+        self.in_flight = {}
+        self.served = {'cache': 0, 'run': 0, 'joined': 0, 'failed': 0, 'restarts': 0}
+
+    async def warm_up(self):
+        """Starts all the workers of the pool."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, warm_up) for _ in range(self.workers)])
+
+    def prepare(self, body):
+        """Config, request and key of a request body, raises ValueError for invalid ones."""
+        name = body.get('config') if isinstance(body, dict) else None
+        if not isinstance(name, (str, type(None))) or name not in self.configs:
+            raise ValueError(f'Unknown config, one of: {", ".join(sorted(str(n) for n in self.configs if n))}')
+        try:
+            config = get_config(self.configs[name])
+        except (OSError, ValueError):
+            # the details may quote the file, they only go to the log of the service
+            logger.exception('Config %s can not be loaded', name)
+            raise ValueError(f'Config {name} can not be loaded') from None
+        request = parse_request(body, config, self.max_agents, self.max_steps)
+        try:
+            return config, request, request_key(config, request)
+        except OSError:
+            logger.exception('Map of %s can not be read', name)
+            raise ValueError(f'Map of scenario {request["scenario"]} can not be read') from None
+
+    async def result(self, config, request, key):
+        """Result of the request and how it was served: 'cache', 'run' or 'joined'."""
+        result = self.cache.get(key)
+        if result is not None:
+            self.served['cache'] += 1
+            return result, 'cache'
+        served = 'joined' if key in self.in_flight else 'run'
+        if served == 'run':
+            executor = self.executor
+            try:
+                future = asyncio.get_running_loop().run_in_executor(executor, run_job, config, request)
+            except BrokenProcessPool:
+                # broken by a run that is already gone
+                executor = self.restart_pool(executor)
+                future = asyncio.get_running_loop().run_in_executor(executor, run_job, config, request)
+            # called before the awaiting requests resume, so they find the result in the cache afterwards
+            future.add_done_callback(functools.partial(self.finish, key, executor))
+            self.in_flight[key] = future
+        self.served[served] += 1
+        # a request that goes away doesn't cancel the run for the others
+        return await asyncio.shield(self.in_flight[key]), served
+
+    def finish(self, key, executor, future):
+        del self.in_flight[key]
+        if future.cancelled() or future.exception() is not None:
+            self.served['failed'] += 1
+            if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                self.restart_pool(executor)
+            return
+        self.cache.put(key, future.result())
+
+    def restart_pool(self, broken):
+        """
+        New pool instead of a broken one, all runs in it failed with it.
+        Does nothing if the broken pool was already replaced.
+        """
+        if broken is self.executor:
+            logger.error('A worker died, starting the pool again')
+            broken.shutdown(wait=False)
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self.served['restarts'] += 1
+        return self.executor
+
+    def stats(self):
+        return dict(self.served, in_flight=len(self.in_flight), workers=self.workers,
+                    cached=len(self.cache), cache_bytes=self.cache.total_bytes)
+
+    def close(self):
+        # runs that haven't started are dropped, the running ones finish in the background
+        for future in self.in_flight.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class ServiceHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+
+class RunHandler(ServiceHandler):
+    async def post(self):
+        try:
+            config, request, key = self.service.prepare(tornado.escape.json_decode(self.request.body or b'{}'))
+        except ValueError as err:
+            self.set_status(400)
+            self.finish({'error': str(err)})
+            return
+        try:
+            result, served = await self.service.result(config, request, key)
+        except Exception:
+            logger.exception('Run of %s failed', request)
+            self.set_status(500)
+            self.finish({'error': 'The run failed'})
+            return
+        self.set_header('X-Cache', 'hit' if served == 'cache' else 'miss')
+        self.finish({'key': key, 'served': served, 'result': result})
+
+
+class ResultHandler(ServiceHandler):
+    def get(self, key):
+        result = self.service.cache.get(key)
+        if result is None:
+            raise tornado.web.HTTPError(404)
+        self.finish({'key': key, 'served': 'cache', 'result': result})
+
+
+class StatsHandler(ServiceHandler):
+    def get(self):
+        self.finish(self.service.stats())
+
+
+def make_app(service):
+    handlers = [(r'/run', RunHandler), (r'/results/([0-9a-f]{40})', ResultHandler), (r'/stats', StatsHandler)]
+    return tornado.web.Application([(path, handler, {'service': service}) for path, handler in handlers])
+
+
+async def serve(service, port=8600, address='127.0.0.1', unix_socket=None):
+    await service.warm_up()
+    server = tornado.httpserver.HTTPServer(make_app(service))
+    if unix_socket is not None:
+        server.add_socket(tornado.netutil.bind_unix_socket(unix_socket))
+    else:
+        server.listen(port, address)
+    print(f'Serving runs on {unix_socket or f"http://{address}:{port}"} with {service.workers} workers')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        service.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=None, help="yml config, configs/designed_shapes.yml if not given")
+    parser.add_argument("--port", default=8600, type=int)
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--unix_socket", default=None, help="path of a unix socket to serve on instead of the port")
+    parser.add_argument("--workers", default=None, type=int)
+    parser.add_argument("--cache_dir", default=None, help="<cache_dir of the config>/results if not given")
+    parser.add_argument("--max_cache_mb", default=512, type=float)
+    parser.add_argument("--max_agents", default=10000, type=int, help="largest num_agents of a request")
+    parser.add_argument("--max_steps", default=5000, type=int, help="largest number of steps of a request")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    service = JobService(args.config, args.cache_dir, int(args.max_cache_mb * 2 ** 20), args.workers,
+                         args.max_agents, args.max_steps)
+    try:
+        asyncio.run(serve(service, args.port, args.address, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
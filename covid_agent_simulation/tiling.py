@@ -0,0 +1,430 @@
+"""
+Stepping a large map in many processes.
+
+The map is split along x into tiles, every tile is stepped by its own worker
+process with the agents standing in it. Cells are flat indices, x * grid height + y,
+so the cells of a tile are a contiguous range. The occupancy layer and the
+number of infectious agents in every cell live in shared memory: a worker
+only writes to the cells of its tile and reads its halo, the columns around
+the tile as wide as the infection radius and at least two columns: moves go to
+cells up to one column outside the tile, and their score counts the agents
+around them, one more column away.
+
+A tick is a sequence of phases, each one run by all workers at once:
+    plan: snapshot the tile and its halo, agents willing to go out join the queue of the tile,
+          count agents outside and coming back home
+    step: return home, move, the oldest agents of the queue go out,
+          agents heading to other tiles become emigrants
+    immigrate: emigrants are admitted by the tile they head to if their cell is free
+    settle: admitted emigrants leave their old tile, infected agents recover or
+            write themselves to the shared sources
+    infect: pressure of the sources in the tile and its halo infects healthy agents,
+            count states and agents outside and in the queue
+Agents never share a cell, so the source of an infection is the agent the shared
+occupancy layer holds in the cell of the source picked by the tile.
+Agents keep their old cell until the tile they head to admits them, so
+a rejected agent simply stays where it was, like an agent losing a claim
+in VectorizedEngine.
+"""
+import multiprocessing
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import ndimage
+
+from .agents import CoronavirusAgentState, InteriorType, EMPTY_CELL
+from .engine import VectorizedEngine, MOORE_KERNEL, first_claims
+from .infection import InfectionKernel
+
+TILE_FIELDS = ['ids', 'pos', 'home_cell', 'home_id', 'state', 'infected_steps', 'outside_steps',
+               'max_infection_steps', 'max_being_out_steps', 'going_out_prob', 'target_index', 'entrance',
+               'queued_since']
+# what brings an emigrant to another tile
+MOVE, RETURN_HOME, GO_OUT = 0, 1, 2
+
+
+class TiledEngine(VectorizedEngine):
+    """
+    Same rules as VectorizedEngine, with the agents distributed over
+    tiles worker processes. The model sees the shared occupancy layer,
+    state counts and snapshots gathered from the workers.
+    """
+    def __init__(self, model, tiles=2, min_infection_steps=10, max_infection_steps=140):
+        width, height = model.home_ids.shape
+        tiles = min(tiles, width)
+        self.shared = {name: shared_memory.SharedMemory(create=True, size=width * height * 8)
+                       for name in ('occupancy', 'sources')}
+        model.occupancy = np.ndarray((width, height), dtype=np.int64, buffer=self.shared['occupancy'].buf)
+        model.occupancy.fill(EMPTY_CELL)
+        super().__init__(model, min_infection_steps, max_infection_steps)
+
+        columns = np.linspace(0, width, tiles + 1).astype(int)
+        self.bounds = columns * height
+        halo = max(len(model.infection_probabilities), 2) * height
+        tile_of_agent = self.tile_of(self.pos)
+        layers = {'home_ids': np.asarray(model.home_ids), 'cell_types': np.asarray(model.cell_types),
+                  'home_group_ids': np.asarray(model.compiled_scenario.home_group_ids),
+                  'home_group_indptr': np.asarray(model.compiled_scenario.home_group_indptr),
+                  'home_group_cells': np.asarray(model.compiled_scenario.home_group_cells),
+                  'neighbors': model.movement.neighbors, 'walkable': model.movement.walkable,
+                  'target_distance': model.movement.target_distance,
+                  'entrance_areas': self.entrance_areas}
+        params = {'num_targets': len(model.available_target_cells),
+                  'infection_probabilities': model.infection_probabilities,
+                  'tick': model.admission.tick,
+                  'transmissions': model.transmissions is not None}
+
+        # cells every tile sees, its own and its halo
+        self.windows = [(max(self.bounds[i] - halo, 0), min(self.bounds[i + 1] + halo, width * height))
+                        for i in range(tiles)]
+        context = multiprocessing.get_context()
+        self.connections, self.workers = [], []
+        for i, seed in enumerate(self.rng.integers(2 ** 63, size=tiles)):
+            window = self.windows[i]
+            agents = {name: getattr(self, name)[tile_of_agent == i] for name in TILE_FIELDS}
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=run_tile, daemon=True,
+                                     args=(worker_connection, i, self.bounds, window,
+                                           {name: memory.name for name, memory in self.shared.items()},
+                                           layers, params, seed, agents))
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+        # agents live in the workers from now on
+        for name in TILE_FIELDS:
+            delattr(self, name)
+        self.finalizer = weakref.finalize(self, shutdown, self.connections, self.workers, self.shared)
+
+    def tile_of(self, cells):
+        return np.searchsorted(self.bounds, cells, side='right') - 1
+
+    def call(self, command, *args_of_tiles):
+        """Runs the command in all workers at once, args_of_tiles has a list of arguments per tile."""
+        for i, connection in enumerate(self.connections):
+            connection.send((command, [args[i] for args in args_of_tiles]))
+        return [connection.recv() for connection in self.connections]
+
+    def step(self):
+        profiler = self.model.profiler
+        tiles = len(self.connections)
+        with profiler.phase('plan'):
+            outside, returning, queues = zip(*self.call('plan'))
+            # agents coming back home make room for the ones in the queue, a few of them
+            # may find their home full and stay out for another tick
+            free_slots = max(self.model.num_agents_allowed_outside - sum(outside) + sum(returning), 0)
+            # the oldest agents of all the queues, in random order within a tick, like in VectorizedEngine
+            queued_since = np.concatenate(queues)
+            tile = np.repeat(np.arange(tiles), [len(queue) for queue in queues])
+            order = self.rng.permutation(len(queued_since))
+            order = order[np.argsort(queued_since[order], kind='stable')][:free_slots]
+            slots = np.bincount(tile[order], minlength=tiles)
+
+        with profiler.phase('move'):
+            emigrants = self.call('step', slots)
+            incoming = [[(origin, records[tile]) for origin, records in enumerate(emigrants) if tile in records]
+                        for tile in range(tiles)]
+            admitted = self.call('immigrate', incoming)
+            self.call('settle', [[admitted[tile].get(origin) for tile in range(tiles)]
+                                 for origin in range(tiles)])
+
+        with profiler.phase('infection'):
+            counts = self.call('infect')
+            admission = self.model.admission
+            self.model.state_counts[:] = np.sum([c['states'] for c in counts], axis=0)
+            admission.occupancy[:] = np.sum([c['entrances'] for c in counts], axis=0)
+            admission.queue_length[...] = sum(c['queued'] for c in counts)
+            admission.admitted += sum(c['admitted'] for c in counts)
+            admission.total_wait += sum(c['total_wait'] for c in counts)
+            admission.next_tick()
+            for c in counts:
+                if 'transmissions' in c:
+                    self.model.record_transmissions(*c['transmissions'])
+
+    def agent_snapshot(self):
+        snapshots = self.call('snapshot')
+        agents = {name: np.concatenate([snapshot[name] for snapshot in snapshots]) for name in snapshots[0]}
+        order = np.argsort(agents['ids'])
+        x, y = np.divmod(agents['pos'][order], self.height)
+        return {'unique_id': agents['ids'][order], 'x': x, 'y': y, 'state': agents['state'][order]}
+
+    def close(self):
+        self.finalizer()
+
+
+def crowd(occupancy, height):
+    """Number of agents around every cell of a range of whole columns of the flat occupancy layer."""
+    occupied = (occupancy != EMPTY_CELL).reshape(-1, height)
+    return ndimage.convolve(occupied.astype(int), MOORE_KERNEL, mode='constant').ravel()
+
+
+def shutdown(connections, workers, shared):
+    for connection in connections:
+        try:
+            connection.send(('close', []))
+        except (BrokenPipeError, OSError):
+            pass
+    for worker in workers:
+        worker.join(timeout=5)
+    for memory in shared.values():
+        memory.close()
+        memory.unlink()
+
+
+def run_tile(connection, *args):
+    tile = Tile(*args)
+    while True:
+        command, args = connection.recv()
+        if command == 'close':
+            tile.close()
+            return
+        connection.send(getattr(tile, command)(*args))
+
+
+class Tile:
+    """The agents of one tile, stepped in a worker process."""
+    def __init__(self, index, bounds, window, shared, layers, params, seed, agents):
+        self.index = index
+        self.bounds = bounds
+        self.lo, self.hi = bounds[index], bounds[index + 1]
+        self.window_lo, self.window_hi = window
+        self.rng = np.random.default_rng(seed)
+        # sources of infections have a stream of their own, like in the model
+        self.transmission_rng = np.random.default_rng([seed, 1]) if params['transmissions'] else None
+        self.memory = {name: shared_memory.SharedMemory(name=memory_name) for name, memory_name in shared.items()}
+        self.height = layers['home_ids'].shape[1]
+        cells = layers['home_ids'].size
+        self.occupancy = np.ndarray(cells, dtype=np.int64, buffer=self.memory['occupancy'].buf)
+        self.sources = np.ndarray(cells, dtype=np.int64, buffer=self.memory['sources'].buf)
+        self.layers = layers
+        self.cell_types = layers['cell_types'].ravel()
+        self.num_targets = params['num_targets']
+        self.tick = params['tick']
+        # agents that went out of the queue in this tick and the ticks they waited
+        self.admitted = 0
+        self.total_wait = 0
+        home_ids = layers['home_ids'][self.window_lo // self.height:self.window_hi // self.height]
+        self.infection_kernel = InfectionKernel(home_ids, params['infection_probabilities'])
+        self.agents = agents
+
+    def __getattr__(self, name):
+        # agent fields, e.g. self.pos
+        if name in TILE_FIELDS:
+            return self.agents[name]
+        raise AttributeError(name)
+
+    def close(self):
+        del self.occupancy, self.sources
+        for memory in self.memory.values():
+            memory.close()
+
+    def owns(self, cells):
+        return (cells >= self.lo) & (cells < self.hi)
+
+    def is_empty(self, cells):
+        """Cells in the window as seen at the beginning of the tick, updated with the moves of this tile."""
+        return self.window[cells - self.window_lo] == EMPTY_CELL
+
+    def plan(self):
+        """Returns the number of agents outside, of the ones coming back home and the ticks the queue joined at."""
+        self.window = self.occupancy[self.window_lo:self.window_hi].copy()
+        at_home = self.cell_types[self.pos] == InteriorType.HOME.value
+        wants_out = at_home & (self.rng.random(len(self.pos)) < self.going_out_prob)
+        self.queued_since[wants_out & (self.queued_since == EMPTY_CELL)] = self.tick
+        self.returning = np.flatnonzero(~at_home & (self.outside_steps > self.max_being_out_steps))
+        return np.count_nonzero(~at_home), len(self.returning), self.queued_since[self.queued_since != EMPTY_CELL]
+
+    def step(self, free_slots):
+        n = len(self.pos)
+        outside = self.cell_types[self.pos] != InteriorType.HOME.value
+        queued = self.rng.permutation(np.flatnonzero(self.queued_since != EMPTY_CELL))
+        going_out = queued[np.argsort(self.queued_since[queued], kind='stable')][:free_slots]
+        returning = self.returning
+
+        moving = np.ones(n, dtype=bool)
+        moving[going_out] = False
+        moving[returning] = False
+        self.outside_steps[moving & outside] += 1
+
+        self.emigrants = []
+        self.return_home(returning)
+        self.move(np.flatnonzero(moving))
+        self.go_out(going_out)
+        return self.group_emigrants()
+
+    def return_home(self, agents):
+        away = ~self.owns(self.home_cell[agents])
+        self.emigrate(agents[away], self.home_cell[agents[away]], RETURN_HOME)
+        for i in agents[~away]:
+            cell = self.home_cell[i]
+            if not self.is_empty(cell):
+                # a housemate stands on our cell, look for another free one of the home in this tile
+                home = self.cells_of_home(self.home_id[i])
+                home = home[self.owns(home)]
+                home = home[self.is_empty(home)]
+                if len(home) == 0:
+                    # the agent will try again in the next tick
+                    continue
+                cell = home[0]
+            self.outside_steps[i] = 0
+            self.entrance[i] = EMPTY_CELL
+            self.relocate(np.array([i]), np.array([cell]))
+
+    def go_out(self, agents):
+        entrance_areas = self.layers['entrance_areas']
+        if len(agents) == 0 or len(entrance_areas) == 0:
+            return
+        entrance = self.rng.integers(len(entrance_areas), size=len(agents))
+        cells = entrance_areas[entrance, self.rng.integers(2, size=len(agents))]
+        targets = self.rng.integers(self.num_targets, size=len(agents))
+        away = ~self.owns(cells)
+        self.emigrate(agents[away], cells[away], GO_OUT, target_index=targets[away], entrance=entrance[away])
+
+        agents, cells, targets, entrance = agents[~away], cells[~away], targets[~away], entrance[~away]
+        admitted = self.is_empty(cells) & first_claims(cells)
+        agents = agents[admitted]
+        self.target_index[agents] = targets[admitted]
+        self.entrance[agents] = entrance[admitted]
+        self.record_admitted(agents)
+        self.relocate(agents, cells[admitted])
+
+    def record_admitted(self, agents):
+        """agents: indices of agents that went out of the queue."""
+        self.admitted += len(agents)
+        self.total_wait += int(np.sum(self.tick - self.queued_since[agents]))
+        self.queued_since[agents] = EMPTY_CELL
+
+    def move(self, agents):
+        if len(agents) == 0:
+            return
+        agents = self.rng.permutation(agents)
+        pos = self.pos[agents]
+        candidates = self.layers['neighbors'][pos]
+        valid = self.layers['walkable'][pos] & self.is_empty(np.maximum(candidates, self.window_lo))
+
+        moore_max_objects = 8
+        scores = 1 - crowd(self.window, self.height)[np.maximum(candidates - self.window_lo, 0)] / moore_max_objects
+
+        targets = self.target_index[agents]
+        distance = self.layers['target_distance'][targets[:, None], candidates]
+        scores += np.where((targets[:, None] != EMPTY_CELL) & (distance > 0), 1 / np.maximum(distance, 1), 0)
+
+        scores = np.where(valid, scores, -np.inf)
+        top = valid & (scores == scores.max(axis=1)[:, None])
+        choice = np.argmax(top * self.rng.random(top.shape), axis=1)
+
+        can_move = valid.any(axis=1)
+        agents = agents[can_move]
+        steps = candidates[can_move, choice[can_move]]
+        winners = first_claims(steps)
+        agents, steps = agents[winners], steps[winners]
+        away = ~self.owns(steps)
+        self.emigrate(agents[away], steps[away], MOVE)
+        self.relocate(agents[~away], steps[~away])
+
+    def relocate(self, agents, cells):
+        self.occupancy[self.pos[agents]] = EMPTY_CELL
+        self.window[self.pos[agents] - self.window_lo] = EMPTY_CELL
+        self.occupancy[cells] = self.ids[agents]
+        self.window[cells - self.window_lo] = self.ids[agents]
+        self.pos[agents] = cells
+
+    def emigrate(self, agents, cells, kind, **updates):
+        if len(agents):
+            self.emigrants.append((agents, cells, kind, updates))
+
+    def group_emigrants(self):
+        """Emigrants by the tile they head to, as copies of their fields with the changes they bring along."""
+        records = []
+        for agents, cells, kind, updates in self.emigrants:
+            record = {name: self.agents[name][agents].copy() for name in TILE_FIELDS}
+            record.update(updates, pos=cells, kind=np.full(len(agents), kind))
+            if kind == RETURN_HOME:
+                record['outside_steps'][:] = 0
+                record['entrance'][:] = EMPTY_CELL
+            records.append(record)
+        if not records:
+            return {}
+        merged = {name: np.concatenate([record[name] for record in records]) for name in records[0]}
+        tiles = np.searchsorted(self.bounds, merged['pos'], side='right') - 1
+        return {int(tile): {name: values[tiles == tile] for name, values in merged.items()}
+                for tile in np.unique(tiles)}
+
+    def immigrate(self, incoming):
+        """Admits the emigrants of other tiles, returns the ids of the admitted ones by their tile."""
+        admitted = {}
+        if not incoming:
+            return admitted
+        origins = np.concatenate([np.full(len(record['ids']), origin) for origin, record in incoming])
+        agents = {name: np.concatenate([record[name] for _, record in incoming]) for name in incoming[0][1]}
+        order = self.rng.permutation(len(origins))
+        origins, agents = origins[order], {name: values[order] for name, values in agents.items()}
+
+        cells = agents['pos']
+        for i in np.flatnonzero((agents['kind'] == RETURN_HOME) & (self.occupancy[cells] != EMPTY_CELL)):
+            home = self.cells_of_home(agents['home_id'][i])
+            home = home[self.owns(home) & (self.occupancy[home] == EMPTY_CELL)]
+            # a full home stays taken, the agent will try again in the next tick
+            if len(home):
+                cells[i] = home[0]
+        ok = (self.occupancy[cells] == EMPTY_CELL) & first_claims(cells)
+        going_out = (agents.pop('kind') == GO_OUT) & ok
+        self.occupancy[cells[ok]] = agents['ids'][ok]
+        first_new = len(self.ids)
+        for name in TILE_FIELDS:
+            self.agents[name] = np.concatenate([self.agents[name], agents[name][ok]])
+        self.record_admitted(first_new + np.flatnonzero(going_out[ok]))
+        for origin in np.unique(origins[ok]):
+            admitted[int(origin)] = agents['ids'][ok & (origins == origin)]
+        return admitted
+
+    def settle(self, admitted):
+        """admitted: ids of the agents of this tile admitted by every other tile."""
+        left = np.concatenate([ids for ids in admitted if ids is not None] + [np.array([], dtype=int)])
+        # they still stand on their old cells
+        leaving = np.isin(self.ids, left)
+        self.occupancy[self.pos[leaving]] = EMPTY_CELL
+        self.agents = {name: values[~leaving] for name, values in self.agents.items()}
+
+        infected = np.flatnonzero(self.state == CoronavirusAgentState.INFECTED.value)
+        recovering = self.infected_steps[infected] >= self.max_infection_steps[infected]
+        self.state[infected[recovering]] = CoronavirusAgentState.RECOVERED.value
+        spreading = infected[~recovering]
+        self.infected_steps[spreading] += 1
+        self.sources[self.lo:self.hi] = np.bincount(self.pos[spreading] - self.lo, minlength=self.hi - self.lo)
+
+    def infect(self):
+        sources = self.sources[self.window_lo:self.window_hi].reshape(-1, self.height)
+        pressure = self.infection_kernel.pressure(sources).ravel()
+        healthy = np.flatnonzero(self.state == CoronavirusAgentState.HEALTHY.value)
+        hit = self.rng.random(len(healthy)) < pressure[self.pos[healthy] - self.window_lo]
+        targets = healthy[hit]
+        self.state[targets] = CoronavirusAgentState.INFECTED.value
+
+        outside = self.entrance[self.entrance != EMPTY_CELL]
+        counts = {'states': np.bincount(self.state, minlength=len(CoronavirusAgentState) + 1),
+                  'entrances': np.bincount(outside, minlength=len(self.layers['entrance_areas'])),
+                  'queued': np.count_nonzero(self.queued_since != EMPTY_CELL),
+                  'admitted': self.admitted, 'total_wait': self.total_wait}
+        if self.transmission_rng is not None and len(targets):
+            counts['transmissions'] = self.attribute(sources.ravel(), targets)
+        self.admitted, self.total_wait = 0, 0
+        self.tick += 1
+        return counts
+
+    def attribute(self, sources, targets):
+        """Source ids, target ids, cells and distance bands of the infections of the agents in targets."""
+        cells = np.flatnonzero(sources)
+        source_cells = np.repeat(cells, sources[cells])
+        target_cells = self.pos[targets]
+        picked, distance = self.infection_kernel.attribute(source_cells, target_cells - self.window_lo,
+                                                           self.transmission_rng)
+        return self.occupancy[source_cells[picked] + self.window_lo], self.ids[targets], target_cells, distance
+
+    def snapshot(self):
+        return {'ids': self.ids, 'pos': self.pos, 'state': self.state}
+
+    def cells_of_home(self, home_id):
+        i = np.searchsorted(self.layers['home_group_ids'], home_id)
+        indptr = self.layers['home_group_indptr']
+        return self.layers['home_group_cells'][indptr[i]:indptr[i + 1]]
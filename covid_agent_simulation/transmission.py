@@ -0,0 +1,149 @@
+"""
+Who infected whom, where and when.
+
+Every infection is appended to a TransmissionLog as a row of
+    tick: step of the model, the row of the curves collected after it
+    source: unique_id of the infecting agent, EMPTY_CELL for the initially infected ones
+    target: unique_id of the infected agent
+    cell: flat cell of the target, x * grid height + y
+    distance: moore distance band between the agents, 1..len(infection_probabilities)
+    at_home: whether it happened at home or in the common space
+    replicate: replicate of the agents, 0 without replicates
+The infection pressure mixes all sources around a cell, so the source of an
+infection is drawn among them by their share of the pressure, see
+InfectionKernel.attribute. Those draws have a random stream of their own,
+runs are the same with and without the log.
+The log is off unless turned on in the config, with_transmissions gives
+a config that turns it on for reproduction_numbers and generation_intervals.
+"""
+import copy
+import os
+
+import numpy as np
+
+from .agents import EMPTY_CELL
+from .datacollection import to_frame
+
+FIELDS = {'tick': np.int32, 'source': np.int64, 'target': np.int64, 'cell': np.int64,
+          'distance': np.int8, 'at_home': np.bool_, 'replicate': np.int32}
+
+
+class TransmissionLog:
+    """
+    Append-only columns of infections, in preallocated arrays doubled when full.
+
+    With output_dir, every chunk_size rows are written to
+    <output_dir>/transmissions_<n>.npz (or .parquet) and dropped, like
+    the curves of ColumnarDataCollector, otherwise all rows stay in memory.
+    """
+    def __init__(self, chunk_size=100000, output_dir=None, file_format='npz', capacity=1024):
+        if file_format not in ('npz', 'parquet'):
+            raise ValueError(f'Unknown file format: {file_format}')
+        self.chunk_size = chunk_size
+        self.output_dir = output_dir
+        self.file_format = file_format
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in FIELDS.items()}
+        self.rows = 0
+        self.flushed_rows = 0
+        self.flushed_chunks = 0
+
+    def __len__(self):
+        return self.flushed_rows + self.rows
+
+    def append(self, tick, source, target, cell, distance, at_home, replicate=0):
+        """Arguments are arrays with a value per infection or values shared by all of them."""
+        n = len(target)
+        if n == 0:
+            return
+        if self.rows + n > len(self.columns['tick']):
+            capacity = max(2 * len(self.columns['tick']), self.rows + n)
+            for name, column in self.columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.rows] = column[:self.rows]
+                self.columns[name] = grown
+        values = {'tick': tick, 'source': source, 'target': target, 'cell': cell,
+                  'distance': distance, 'at_home': at_home, 'replicate': replicate}
+        for name, value in values.items():
+            self.columns[name][self.rows:self.rows + n] = value
+        self.rows += n
+
+        if self.output_dir is not None and self.rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the rows kept in memory to a new chunk, only with output_dir."""
+        if self.output_dir is None or self.rows == 0:
+            return
+        chunk = {name: column[:self.rows] for name, column in self.columns.items()}
+        path = os.path.join(self.output_dir, f'transmissions_{self.flushed_chunks:05d}.{self.file_format}')
+        if self.file_format == 'npz':
+            np.savez(path, **chunk)
+        else:
+            to_frame(chunk).to_parquet(path)
+        self.flushed_rows += self.rows
+        self.flushed_chunks += 1
+        self.rows = 0
+
+    @property
+    def events(self):
+        """All the rows logged so far, written to disk or not, as a dict of arrays."""
+        chunks = []
+        for i in range(self.flushed_chunks):
+            path = os.path.join(self.output_dir, f'transmissions_{i:05d}.{self.file_format}')
+            if self.file_format == 'npz':
+                with np.load(path) as chunk:
+                    chunks.append({name: chunk[name] for name in FIELDS})
+            else:
+                import pandas as pd
+                frame = pd.read_parquet(path)
+                chunks.append({name: frame[name].values for name in FIELDS})
+        chunks.append({name: column[:self.rows] for name, column in self.columns.items()})
+        return {name: np.concatenate([chunk[name] for chunk in chunks]).astype(dtype, copy=False)
+                for name, dtype in FIELDS.items()}
+
+    def restore(self, events):
+        """Starts over from rows logged by another log, e.g. in a checkpoint."""
+        self.rows = 0
+        self.append(**events)
+
+    def get_dataframe(self):
+        return to_frame(self.events)
+
+
+def with_transmissions(config):
+    """Copy of the config that logs every infection, the shipped one doesn't."""
+    config = copy.deepcopy(config)
+    config['common'].setdefault('datacollector', {})['transmissions'] = True
+    return config
+
+
+def infection_ticks(events):
+    """Unique ids of the infected agents, sorted, and the tick every one of them got infected at."""
+    order = np.argsort(events['target'], kind='stable')
+    return events['target'][order], events['tick'][order]
+
+
+def reproduction_numbers(events, num_ticks=None):
+    """
+    Case reproduction number R_t, the mean number of agents infected by the
+    agents that got infected at tick t, NaN for ticks without infections.
+    The last ticks are underestimated, their agents haven't finished infecting.
+    Events of many replicates give R_t pooled over them, agents have unique ids across replicates.
+    """
+    ids, ticks = infection_ticks(events)
+    sources = events['source'][events['source'] != EMPTY_CELL]
+    source_ticks = ticks[np.searchsorted(ids, sources)]
+    num_ticks = int(events['tick'].max()) + 1 if num_ticks is None else num_ticks
+    infected = np.bincount(events['tick'], minlength=num_ticks)[:num_ticks]
+    secondary = np.bincount(source_ticks, minlength=num_ticks)[:num_ticks]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(infected > 0, secondary / infected, np.nan)
+
+
+def generation_intervals(events):
+    """Ticks between the infection of the source and the one of the target, for every infection with a source."""
+    ids, ticks = infection_ticks(events)
+    known = events['source'] != EMPTY_CELL
+    return events['tick'][known] - ticks[np.searchsorted(ids, events['source'][known])]
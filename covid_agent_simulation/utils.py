@@ -1,10 +1,68 @@
+import copy
+import functools
+import os
+
 import yaml
 
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# maps in the configs are relative to the root of the repository
+PROJECT_DIR = os.path.dirname(PACKAGE_DIR)
+CONFIG_DIR = os.path.join(PACKAGE_DIR, 'configs')
+DEFAULT_CONFIG = os.path.join(CONFIG_DIR, 'designed_shapes.yml')
+
+# keys the model can't run without, by section, environment keys are checked for every scenario
+REQUIRED_KEYS = {'common': ['random_seed', 'initially_infected_population', 'initially_recovered_population',
+                            'infection_probabilities'],
+                 'environment': ['map_path', 'num_agents_allowed', 'max_time_outside', 'num_target_cells',
+                                 'entrance_cells'],
+                 'agent': ['healthy', 'infected', 'recovered']}
+
+
+def get_config(path=None):
+    """
+    path: yml file, DEFAULT_CONFIG if not given. Paths that don't exist relative to
+    the working directory are looked up in the repository and in its configs directory.
+    A file is parsed and validated once, every call returns its own copy of the config.
+    """
+    path = resolve_path(path or DEFAULT_CONFIG, PROJECT_DIR, CONFIG_DIR)
+    return copy.deepcopy(load_config(os.path.abspath(path), os.path.getmtime(path)))
+
 
-def get_config(path):
+@functools.lru_cache(maxsize=None)
+def load_config(path, mtime):
+    """mtime is only a part of the key of the cache, so that edited files are read again."""
     with open(path, 'r') as f:
         try:
             config = yaml.safe_load(f)
         except yaml.YAMLError as err:
-            print(err)
-        return config
+            raise ValueError(f'{path} is not a valid yml file: {err}') from err
+    validate_config(config, path)
+    for environment in config['environment'].values():
+        environment['map_path'] = resolve_path(environment['map_path'], PROJECT_DIR)
+    return config
+
+
+def validate_config(config, path):
+    if not isinstance(config, dict):
+        raise ValueError(f'{path} has no sections')
+    missing = [section for section in REQUIRED_KEYS if not isinstance(config.get(section), dict)]
+    if missing:
+        raise ValueError(f'{path} has no {", ".join(missing)} section')
+    sections = [('common', config['common']), ('agent', config['agent'])]
+    sections += [(f'environment/{scenario}', environment or {})
+                 for scenario, environment in config['environment'].items()]
+    for name, section in sections:
+        keys = REQUIRED_KEYS[name.split('/')[0]]
+        missing = [key for key in keys if key not in section]
+        if missing:
+            raise ValueError(f'{path} has no {", ".join(missing)} in {name}')
+
+
+def resolve_path(path, *bases):
+    """The path itself if it exists, otherwise the first of the bases it exists in."""
+    if os.path.isabs(path) or os.path.exists(path):
+        return path
+    for base in bases:
+        if os.path.exists(os.path.join(base, path)):
+            return os.path.join(base, path)
+    return path
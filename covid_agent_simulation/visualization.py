@@ -0,0 +1,61 @@
+import base64
+import json
+import weakref
+
+import numpy as np
+from mesa.visualization.ModularVisualization import VisualizationElement
+
+from .agents import CoronavirusAgentState, InteriorType, EMPTY_CELL
+
+# colors of the cells of the map, the same as the ones of InteriorAgents
+MAP_COLORS = {InteriorType.UNREACHABLE: 'white',
+              InteriorType.COMMON_SPACE: '#D9E8FC',
+              InteriorType.HOME: 'lightgray'}
+
+
+class DeltaCanvasGrid(VisualizationElement):
+    """
+    Draws the model like CanvasGrid, but without portrayals of every object.
+
+    The map is sent once for a new model, as cell types, and then every
+    frame only carries the cells whose agent changed since the previous one,
+    as (cell, state) pairs where state is EMPTY_CELL for a cell left empty.
+    Arrays are sent as base64 encoded little endian typed arrays,
+    decoded in DeltaCanvasModule.js.
+    """
+    local_includes = ['covid_agent_simulation/resources/DeltaCanvasModule.js']
+
+    def __init__(self, config, grid_width, grid_height, canvas_width=500, canvas_height=500):
+        self.grid_width = grid_width
+        self.grid_height = grid_height
+        map_colors = [MAP_COLORS[interior_type] for interior_type in InteriorType]
+        # indexed by CoronavirusAgentState value
+        agent_styles = [None] + [config['agent'][state.name.lower()] for state in CoronavirusAgentState]
+        self.js_code = 'elements.push(new DeltaCanvasModule({}, {}, {}, {}, {}, {}));'.format(
+            canvas_width, canvas_height, grid_width, grid_height,
+            json.dumps(map_colors), json.dumps(agent_styles))
+        self.model = None
+        self.frame = None
+
+    def render(self, model):
+        snapshot = model.agent_snapshot()
+        frame = np.full(self.grid_width * self.grid_height, EMPTY_CELL, dtype=np.int32)
+        frame[snapshot['x'] * self.grid_height + snapshot['y']] = snapshot['state']
+
+        if self.model is None or self.model() is not model:
+            # a new model, the browser starts over with a blank canvas
+            self.model = weakref.ref(model)
+            previous = np.full_like(frame, EMPTY_CELL)
+            data = {'map': encode(np.asarray(model.cell_types).ravel(), '<i1')}
+        else:
+            previous = self.frame
+            data = {}
+        self.frame = frame
+        dirty = np.flatnonzero(frame != previous)
+        data['cells'] = encode(np.stack([dirty, frame[dirty]], axis=1), '<i4')
+        return data
+
+
+def encode(array, dtype):
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode('ascii')
+
@@ -1,3 +1,14 @@
-from covid_agent_simulation.server import server
+import argparse
 
-server.launch()
+from covid_agent_simulation.server import create_server
+from covid_agent_simulation.utils import get_config
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config", default=None, help="yml config, the default one if not given")
+parser.add_argument("--live", action='store_true',
+                    help="step the model in the background instead of on requests of the browser")
+parser.add_argument("--frame_rate", default=10, type=float)
+# mesa runserver runs this file with its own arguments
+args, _ = parser.parse_known_args()
+
+create_server(get_config(args.config), args.live, args.frame_rate).launch()
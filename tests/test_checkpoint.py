@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from covid_agent_simulation.checkpoint import fork
+from covid_agent_simulation.model import CoronavirusModel
+from covid_agent_simulation.utils import get_config
+
+
+def curves(model, steps):
+    model.run_model(steps)
+    series = model.datacollector.get_model_vars_dataframe()
+    return series[['Infected', 'Healthy', 'Recovered']].values
+
+
+@pytest.mark.parametrize('engine', ['mesa', 'vectorized'])
+def test_branches_diverge_and_are_reproducible(engine):
+    model = CoronavirusModel(num_agents=40, config=get_config(), scenario='store', engine=engine, seed=1,
+                             with_interiors=False, going_out_prob_mean=0.5)
+    model.run_model(10)
+    branches = [fork(model, branch) for branch in (0, 1, 0)]
+    first, second, again = [curves(branch, 40) for branch in branches]
+    assert not np.array_equal(first, second)
+    np.testing.assert_array_equal(first, again)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from covid_agent_simulation.model import CoronavirusModel
+from covid_agent_simulation.utils import get_config
+
+SEEDS = range(12)
+STEPS = 60
+
+
+def final_states(config, scenario, engine, seeds=SEEDS, **kwargs):
+    """Infected and Recovered percentages after STEPS ticks, one row per seed."""
+    finals = []
+    for seed in seeds:
+        model = CoronavirusModel(num_agents=50, config=config, scenario=scenario, engine=engine, seed=seed,
+                                 with_interiors=False, going_out_prob_mean=0.5, **kwargs)
+        with model:
+            model.run_model(STEPS)
+        series = model.datacollector.get_model_vars_dataframe()
+        finals.append((series['Infected'].iloc[-1], series['Recovered'].iloc[-1]))
+    return np.array(finals)
+
+
+def assert_same_distribution(a, b):
+    """Means within three standard errors (and a few points of slack) and no significant KS difference."""
+    for column in range(a.shape[1]):
+        standard_error = np.sqrt(a[:, column].var() / len(a) + b[:, column].var() / len(b))
+        assert abs(a[:, column].mean() - b[:, column].mean()) <= 3 * standard_error + 5
+        assert stats.ks_2samp(a[:, column], b[:, column]).pvalue > 0.001
+
+
+@pytest.fixture(scope='module')
+def config():
+    return get_config()
+
+
+@pytest.mark.parametrize('scenario', ['store', 'park'])
+def test_vectorized_matches_mesa(config, scenario):
+    assert_same_distribution(final_states(config, scenario, 'mesa'),
+                             final_states(config, scenario, 'vectorized'))
+
+
+def test_tiled_matches_vectorized(config):
+    assert_same_distribution(final_states(config, 'park', 'vectorized'),
+                             final_states(config, 'park', 'tiled', tiles=3))
@@ -0,0 +1,30 @@
+import numpy as np
+
+from covid_agent_simulation.model import CoronavirusModel
+from covid_agent_simulation.utils import get_config
+
+
+def ensemble(stopping, replicates=8):
+    config = get_config()
+    config['common']['stopping'] = stopping
+    return CoronavirusModel(num_agents=50, config=config, scenario='store', engine='vectorized', seed=1,
+                            with_interiors=False, going_out_prob_mean=0.5, replicates=replicates)
+
+
+def test_stops_at_confidence_bound():
+    model = ensemble({'infected_upper_bound': 5})
+    model.run_model(500)
+    assert model.stop_reason == 'confidence_bound'
+    # one column per replicate
+    infected = model.datacollector.model_vars['Infected']
+    final = infected[-1]
+    assert final.mean() + 1.96 * final.std(ddof=1) / np.sqrt(len(final)) <= 5
+    # the bound wasn't reached a tick earlier
+    before = infected[-2]
+    assert before.mean() + 1.96 * before.std(ddof=1) / np.sqrt(len(before)) > 5
+
+
+def test_runs_on_without_criteria():
+    model = ensemble({})
+    model.run_model(30)
+    assert model.running and model.stop_reason is None
@@ -0,0 +1,32 @@
+import numpy as np
+
+from covid_agent_simulation.model import CoronavirusModel
+from covid_agent_simulation.tiling import crowd
+from covid_agent_simulation.utils import get_config
+
+
+def test_tiles_see_the_crowd_around_their_moves():
+    config = get_config()
+    # a single infection band gives the narrowest halo
+    config['common']['infection_probabilities'] = [0.5]
+    config['environment']['park']['num_agents_allowed'] = 200
+    model = CoronavirusModel(num_agents=200, config=config, scenario='park', engine='tiled', seed=3,
+                             with_interiors=False, going_out_prob_mean=10, tiles=3)
+    engine = model.engine
+    height = model.home_ids.shape[1]
+    neighbors, walkable = model.movement.neighbors, model.movement.walkable
+    checked = 0
+    with model:
+        for _ in range(40):
+            model.step()
+            occupancy = model.occupancy.ravel()
+            untiled = crowd(occupancy, height)
+            for (lo, hi), (window_lo, window_hi) in zip(zip(engine.bounds, engine.bounds[1:]), engine.windows):
+                # the cells agents of the tile may move to
+                candidates = neighbors[lo:hi][walkable[lo:hi]]
+                tiled = crowd(occupancy[window_lo:window_hi], height)[candidates - window_lo]
+                np.testing.assert_array_equal(tiled, untiled[candidates])
+                outside = (candidates < lo) | (candidates >= hi)
+                checked += np.count_nonzero(untiled[candidates[outside]])
+    # tile borders cut through crowds
+    assert checked
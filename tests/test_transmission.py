@@ -0,0 +1,27 @@
+import numpy as np
+
+from covid_agent_simulation.model import CoronavirusModel
+from covid_agent_simulation.transmission import generation_intervals, reproduction_numbers, with_transmissions
+from covid_agent_simulation.utils import get_config
+
+
+def run(config, seed=1):
+    model = CoronavirusModel(num_agents=50, config=config, scenario='store', engine='vectorized', seed=seed,
+                             with_interiors=False, going_out_prob_mean=0.5)
+    model.run_model(60)
+    return model
+
+
+def test_log_is_opt_in():
+    config = get_config()
+    assert run(config).transmissions is None
+    model = run(with_transmissions(config))
+    events = model.transmissions.events
+    # every infected agent has one event, the initially infected ones without a source
+    assert len(np.unique(events['target'])) == len(events['target'])
+    assert np.all(generation_intervals(events) > 0)
+    assert len(reproduction_numbers(events, 61)) == 61
+    # the log has a random stream of its own
+    np.testing.assert_array_equal(run(config).datacollector.model_vars['Infected'],
+                                  model.datacollector.model_vars['Infected'])
+    assert not config['common']['datacollector']['transmissions']